@@ -92,6 +92,7 @@ redis_client = Redis(
 # activate a command
 import kirin.command.load_realtime
 import kirin.command.piv_worker
+import kirin.command.cots_messages
 
 from kirin.core import model
 
@@ -108,7 +109,21 @@ logger.info("Configs: %s", app.config)
 
 from kirin.rabbitmq_handler import RabbitMQHandler
 
-rmq_handler = RabbitMQHandler(app.config[str("RABBITMQ_CONNECTION_STRING")], app.config[str("EXCHANGE")])
+rmq_handler = RabbitMQHandler(
+    app.config[str("RABBITMQ_CONNECTION_STRING")],
+    app.config[str("EXCHANGE")],
+    producer_pool_size=app.config[str("RABBITMQ_PRODUCER_POOL_SIZE")],
+    async_config=(
+        {
+            "queue_size": app.config[str("RABBITMQ_ASYNC_PUBLISH_QUEUE_SIZE")],
+            "coalesce_window": app.config[str("RABBITMQ_ASYNC_PUBLISH_COALESCE_WINDOW")],
+            "max_batch_size": app.config[str("RABBITMQ_ASYNC_PUBLISH_MAX_BATCH_SIZE")],
+            "submit_timeout": app.config[str("RABBITMQ_ASYNC_PUBLISH_SUBMIT_TIMEOUT")],
+        }
+        if app.config[str("RABBITMQ_ASYNC_PUBLISH")]
+        else None
+    ),
+)
 
 import kirin.api
 from kirin import utils
@@ -0,0 +1,50 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+from kirin import manager
+from kirin.cots.message_handler import make_message_handler
+import logging
+
+
+@manager.command
+def warm_cots_messages():
+    """
+    Load the ParIV-Motif cause message referential of COTS in cache, typically at startup
+    (useful with a cache shared between processes, see CACHE_TYPE)
+    """
+    logger = logging.getLogger(__name__)
+    message_handler = make_message_handler()
+    if not (message_handler.token_server and message_handler.resource_server):
+        logger.warning("COTS cause message sub-service is not configured, nothing to load")
+        return
+    messages = message_handler.warm_messages()
+    logger.info("%s COTS cause messages loaded in cache", len(messages))
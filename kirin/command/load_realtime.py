@@ -40,5 +40,8 @@ def load_realtime():
     Launch the server that serve realtime updates to starting kraken
     """
     kirin.rmq_handler.listen_load_realtime(
-        kirin.app.config[str("LOAD_REALTIME_QUEUE")], kirin.app.config[str("MAX_RETRIES")]
+        kirin.app.config[str("LOAD_REALTIME_QUEUE")],
+        kirin.app.config[str("MAX_RETRIES")],
+        streaming=kirin.app.config[str("LOAD_REALTIME_STREAMING")],
+        chunk_max_size=kirin.app.config[str("LOAD_REALTIME_CHUNK_MAX_SIZE")],
     )
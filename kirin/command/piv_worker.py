@@ -33,14 +33,19 @@ from kirin import manager, app
 from kirin.core.model import Contributor, db
 from kirin.core.types import ConnectorType
 from kirin.core.abstract_builder import wrap_build
+from kirin.core.builder_cache import get_builder
+from kirin.new_relic import is_invalid_input_exception
 from kirin.piv import KirinModelBuilder
 from kirin.piv.piv import get_piv_contributors, get_piv_contributor
+from kirin.utils import record_builder_reload
 
 from kombu.mixins import ConsumerMixin
+from sqlalchemy.orm.util import identity_key
 from kombu import Connection, Exchange, Queue
 from datetime import datetime, timedelta
 from copy import deepcopy
 import logging
+import threading
 import time
 
 logger = logging.getLogger(__name__)
@@ -70,7 +75,9 @@ class PivWorker(ConsumerMixin):
             raise ValueError("Missing 'queue_name' configuration for contributor '{0}'".format(contributor.id))
         self.last_config_checked_time = datetime.now()
         self.broker_url = deepcopy(contributor.broker_url)
-        self.builder = KirinModelBuilder(contributor)
+        self.builder = get_builder(KirinModelBuilder, contributor)
+        self.contributor_fingerprint = contributor.config_fingerprint()
+        self.builder_reload_count = 0
 
     def __enter__(self):
         self.connection = Connection(self.builder.contributor.broker_url)
@@ -92,15 +99,42 @@ class PivWorker(ConsumerMixin):
             Consumer(
                 queues=[self.queue],
                 accept=["application/json"],
-                prefetch_count=1,
+                prefetch_count=app.config.get(str("PIV_WORKER_PREFETCH_COUNT"), 1),
                 callbacks=[self.process_message],
             )
         ]
 
     def process_message(self, body, message):
-        wrap_build(self.builder, body)
-        # TODO: We might want to not acknowledge the message in case of error in
-        # the processing.
+        """
+        The message is acknowledged only once processed successfully, so that another worker
+        (or this one) processes it again otherwise.
+        A message is requeued once (not waiting in this callback, that would block the connection),
+        then rejected if it fails again (dead-lettered if the queue has a dead-letter exchange).
+        An invalid message is rejected right away, as processing it again would fail the same way.
+        """
+        try:
+            wrap_build(self.builder, body)
+        except Exception as e:
+            if is_invalid_input_exception(e):
+                logger.warning(
+                    "contributor '{0}': invalid message rejected: {1}".format(self.builder.contributor.id, e)
+                )
+                message.reject(requeue=False)
+            elif message.delivery_info.get("redelivered"):
+                logger.warning(
+                    "contributor '{0}': message processing failed again, message rejected: {1}".format(
+                        self.builder.contributor.id, e
+                    )
+                )
+                message.reject(requeue=False)
+            else:
+                logger.warning(
+                    "contributor '{0}': message processing failed, message requeued: {1}".format(
+                        self.builder.contributor.id, e
+                    )
+                )
+                message.requeue()
+            return
         message.ack()
 
     def on_iteration(self):
@@ -109,7 +143,11 @@ class PivWorker(ConsumerMixin):
         else:
             # SQLAlchemy is not querying the DB for read (uses cache instead),
             # unless we specifically tell that the data is expired.
-            db.session.expire(self.builder.contributor, ["broker_url", "exchange_name", "queue_name"])
+            # The builder's contributor may be a copy outside of the session (see get_builder()),
+            # so the contributor of the session is expired.
+            contributor = db.session.identity_map.get(identity_key(Contributor, self.builder.contributor.id))
+            if contributor is not None:
+                db.session.expire(contributor)
             self.last_config_checked_time = datetime.now()
         contributor = get_piv_contributor(self.builder.contributor.id)
         if not contributor:
@@ -133,31 +171,61 @@ class PivWorker(ConsumerMixin):
                 "queue name for contributor '{0}' changed, worker updated".format(contributor.queue_name)
             )
             self.queue = self._get_queue(self.exchange, contributor.queue_name)
-        self.builder = KirinModelBuilder(contributor)
+        # the builder (and its caches) is kept as long as the contributor's configuration is unchanged
+        contributor_fingerprint = contributor.config_fingerprint()
+        if contributor_fingerprint != self.contributor_fingerprint:
+            logger.info("configuration of contributor '{0}' changed, builder reloaded".format(contributor.id))
+            self.builder = get_builder(KirinModelBuilder, contributor)
+            self.contributor_fingerprint = contributor_fingerprint
+            self.builder_reload_count += 1
+            record_builder_reload(contributor.id, self.builder_reload_count)
+
+
+def _run_piv_worker(contributor_id):
+    """
+    Consume the queue of a PIV contributor until it's deactivated or removed
+    (the worker is started again if it dies or if the contributor's broker changes)
+    """
+    with app.app_context():
+        while True:
+            contributor = get_piv_contributor(contributor_id)
+            if not contributor:
+                logger.info("contributor '{0}' is not an active PIV contributor anymore".format(contributor_id))
+                return
+            try:
+                with PivWorker(contributor) as worker:
+                    logger.info("launching the PIV worker for '{0}'".format(contributor.id))
+                    worker.run()
+            except Exception as e:
+                logger.warning("worker of '{0}' died unexpectedly: {1}".format(contributor_id, e))
+                time.sleep(CONF_RELOAD_INTERVAL.total_seconds())
+            finally:
+                db.session.remove()
 
 
 @manager.command
 def piv_worker():
-    import sys
-
-    # We assume one and only one PIV contributor is going to exist in the DB
+    """
+    Consume the queues of all active PIV contributors, with PIV_WORKER_CONCURRENCY workers
+    (each one with its own connection to the broker) by contributor.
+    Workers of new contributors are started every BROKER_CONSUMER_CONFIGURATION_RELOAD_INTERVAL.
+    As messages are acknowledged once processed, several piv_worker processes can share the load.
+    Note: with more than 1 worker by contributor, messages of a contributor may be processed out of order.
+    """
+    concurrency = app.config.get(str("PIV_WORKER_CONCURRENCY"), 1)
+    threads = {}  # {(contributor_id, worker_index): thread}
     while True:
         contributors = get_piv_contributors()
         if len(contributors) == 0:
             logger.warning("no PIV contributor")
-            time.sleep(CONF_RELOAD_INTERVAL.total_seconds())
-            continue
-        contributor = contributors[0]
-        if len(contributors) > 1:
-            logger.warning(
-                "more than one PIV contributors: {0}; choosing '{1}'".format(
-                    map(lambda c: c.id, contributors), contributor.id
-                )
-            )
-        try:
-            with PivWorker(contributor) as worker:
-                logger.info("launching the PIV worker for '{0}'".format(contributor.id))
-                worker.run()
-        except Exception as e:
-            logger.warning("worker died unexpectedly: {0}".format(e))
-            time.sleep(CONF_RELOAD_INTERVAL.total_seconds())
+        for contributor in contributors:
+            for worker_index in range(concurrency):
+                key = (contributor.id, worker_index)
+                if key in threads and threads[key].is_alive():
+                    continue
+                thread = threading.Thread(target=_run_piv_worker, args=(contributor.id,))
+                thread.daemon = True
+                thread.start()
+                threads[key] = thread
+        db.session.remove()
+        time.sleep(CONF_RELOAD_INTERVAL.total_seconds())
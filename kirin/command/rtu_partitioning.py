@@ -0,0 +1,60 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+from kirin import manager, app
+from kirin.core import rtu_partitions
+from kirin.core.model import db
+import logging
+
+
+@manager.command
+def partition_rt_update():
+    """
+    partition table real_time_update by connector and day (requires PostgreSQL >= 11),
+    it's then purged by dropping partitions (see kirin.core.rtu_partitions)
+    """
+    logging.getLogger(__name__).info("partitioning table real_time_update")
+    rtu_partitions.partition_real_time_update(
+        db.session, ahead_days=app.config.get(str("RT_UPDATE_PARTITIONS_AHEAD_DAYS"), 3)
+    )
+    db.session.commit()
+
+
+@manager.command
+def unpartition_rt_update():
+    """
+    rebuild table real_time_update as a regular (not partitioned) table
+    """
+    logging.getLogger(__name__).info("unpartitioning table real_time_update")
+    rtu_partitions.unpartition_real_time_update(db.session)
+    db.session.commit()
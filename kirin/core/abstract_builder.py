@@ -38,14 +38,34 @@ from typing import Tuple, List, Dict, Any
 
 import navitia_wrapper
 import six
+import sqlalchemy
 from flask import current_app
+from sqlalchemy.orm.attributes import set_committed_value
 
 from kirin import core, redis_client
 from kirin.core import model
 from kirin.core.model import Contributor, RealTimeUpdate, TripUpdate
 from kirin.exceptions import KirinException
 from kirin.new_relic import is_invalid_input_exception, record_custom_parameter
-from kirin.utils import set_rtu_status_ko, allow_reprocess_same_data, record_call
+from kirin.utils import (
+    set_rtu_status_ko,
+    allow_reprocess_same_data,
+    record_call,
+    is_raw_data_stored_first,
+    is_same_content_as_last,
+    manage_db_no_new,
+)
+
+
+def _rollback_processing(rt_update):
+    # type: (RealTimeUpdate) -> None
+    """
+    Rollback the current transaction, keeping the RealTimeUpdate (still in memory) ready to be stored again
+    """
+    model.db.session.rollback()
+    if not sqlalchemy.inspect(rt_update).persistent:
+        # the RealTimeUpdate was not committed: TripUpdates linked to it must not be stored by cascade
+        set_committed_value(rt_update, "trip_updates", [])
 
 
 def wrap_build(builder, input_raw):
@@ -56,6 +76,16 @@ def wrap_build(builder, input_raw):
     :param input_raw: the feed to process
     """
     contributor = builder.contributor
+    if current_app.config.get(str("CONTENT_HASH_DEDUPLICATION")) and is_same_content_as_last(
+        contributor.id, input_raw
+    ):
+        # unchanged input: nothing to parse, compute or store
+        logging.getLogger(__name__).info(
+            "same content as the last input, skipping processing", extra={"contributor": contributor.id}
+        )
+        manage_db_no_new(connector_type=contributor.connector_type, contributor_id=contributor.id)
+        return
+
     start_datetime = datetime.utcnow()
     rt_update = None
     log_dict = {"contributor": contributor.id}
@@ -73,6 +103,7 @@ def wrap_build(builder, input_raw):
         # finally confront to previously existing information (base_schedule, previous real-time)
         _, handler_log_dict = core.handle(rt_update, trip_updates, contributor.id, builder.is_new_complete)
         log_dict.update(handler_log_dict)
+        builder.on_rt_update_handled(rt_update)
 
     except Exception as e:
         status = "failure"
@@ -82,6 +113,9 @@ def wrap_build(builder, input_raw):
             allow_reprocess = False  # reprocess is useless if input is invalid
 
         if rt_update is not None:
+            if not is_raw_data_stored_first():
+                # raw data is stored with the KO status only: nothing from the failed processing is kept
+                _rollback_processing(rt_update)
             error = e.data["error"] if (isinstance(e, KirinException) and "error" in e.data) else e.message
             set_rtu_status_ko(rt_update, error, is_reprocess_same_data_allowed=allow_reprocess)
             model.db.session.add(rt_update)
@@ -146,3 +180,10 @@ class AbstractKirinModelBuilder(six.with_metaclass(ABCMeta, object)):
         :return log_dict: dict of (k,v) to be displayed in logs and newrelic
         """
         raise NotImplementedError("Please implement this method")
+
+    def on_rt_update_handled(self, rt_update):
+        # type: (RealTimeUpdate) -> None
+        """
+        Called once the TripUpdates built from rt_update are handled (persisted and published) successfully
+        """
+        pass
@@ -0,0 +1,154 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+# process-wide cache of KirinModelBuilders: {(builder_class, contributor_id): _CachedBuilder}
+_cached_builders = {}
+_cached_builders_lock = threading.Lock()
+
+
+class IntervalCheck(object):
+    """
+    Something checked at most every interval (like navitia's publication date), shareable between threads
+    """
+
+    def __init__(self):
+        self.checked_at = time.time()
+        self._lock = threading.Lock()
+
+    def is_due(self, interval):
+        """
+        :param interval: minimum interval between two checks (in seconds)
+        :return: True if the check is due (it's then considered done)
+        """
+        now = time.time()
+        with self._lock:
+            if now - self.checked_at < interval:
+                return False
+            self.checked_at = now
+            return True
+
+
+def _get_publication_date(navitia):
+    try:
+        return navitia.get_publication_date()
+    except Exception:
+        logging.getLogger(__name__).exception("unable to get navitia's publication date")
+        return None
+
+
+class PublicationDateWatcher(object):
+    """
+    Watch navitia's publication date, to invalidate what is built from navitia's data when it changes
+    """
+
+    def __init__(self, navitia, publication_date=None):
+        """
+        :param publication_date: navitia's publication date if already known (requested otherwise)
+        """
+        self.publication_date = publication_date if publication_date else _get_publication_date(navitia)
+        self.check = IntervalCheck()
+
+    def is_up_to_date(self, navitia, check_interval):
+        """
+        :param check_interval: minimum interval between two requests of the publication date (in seconds)
+        :return: False if navitia's publication date changed since the last check
+        """
+        if not self.check.is_due(check_interval):
+            return True
+        publication_date = _get_publication_date(navitia)
+        is_up_to_date = publication_date == self.publication_date
+        self.publication_date = publication_date
+        return is_up_to_date
+
+
+class _CachedBuilder(object):
+    def __init__(self, builder, config_fingerprint, now):
+        self.builder = builder
+        self.config_fingerprint = config_fingerprint
+        self.created_at = now
+        # some builders (like GTFS-RT's) already requested navitia's publication date
+        self.publication_date_watcher = PublicationDateWatcher(
+            builder.navitia, getattr(builder, "instance_data_pub_date", None)
+        )
+
+
+def get_builder(builder_class, contributor):
+    """
+    Get a KirinModelBuilder for the contributor from a process-wide cache (if BUILDER_CACHE is activated),
+    so that builders (and their navitia wrapper) are not built again for each feed.
+    A builder is built again if:
+        * the contributor's configuration changed
+        * navitia's publication date changed (checked every BUILDER_CACHE_PUBDATE_CHECK_INTERVAL seconds)
+        * it's older than BUILDER_CACHE_TTL seconds
+
+    The builder gets a copy of the contributor (see Contributor.copy()), so that it can be shared.
+    :param builder_class: KirinModelBuilder class of the contributor's connector
+    :param contributor: Contributor up-to-date
+    """
+    if not current_app.config.get(str("BUILDER_CACHE")):
+        return builder_class(contributor)
+
+    now = datetime.utcnow()
+    key = (builder_class, contributor.id)
+    config_fingerprint = contributor.config_fingerprint()
+    with _cached_builders_lock:
+        cached = _cached_builders.get(key)
+
+    ttl = timedelta(seconds=current_app.config.get(str("BUILDER_CACHE_TTL"), 3600))
+    if (
+        cached
+        and cached.config_fingerprint == config_fingerprint
+        and now - cached.created_at < ttl
+        and cached.publication_date_watcher.is_up_to_date(
+            cached.builder.navitia, current_app.config.get(str("BUILDER_CACHE_PUBDATE_CHECK_INTERVAL"), 60)
+        )
+    ):
+        return cached.builder
+
+    builder = builder_class(contributor.copy())
+    cached = _CachedBuilder(builder, config_fingerprint, now)
+    with _cached_builders_lock:
+        _cached_builders[key] = cached
+    return builder
+
+
+def clear_builder_cache():
+    with _cached_builders_lock:
+        _cached_builders.clear()
@@ -0,0 +1,232 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+import datetime
+
+import sqlalchemy
+from psycopg2.extras import execute_values
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import make_transient, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from kirin.core import model
+from kirin.core.model import (
+    RealTimeUpdate,
+    TripUpdate,
+    VehicleJourney,
+    StopTimeUpdate,
+    associate_realtimeupdate_tripupdate,
+)
+
+
+def can_bulk_persist(real_time_update):
+    """
+    The bulk path only handles a RealTimeUpdate already in db or about to be (see make_rt_update()),
+    on PostgreSQL
+    """
+    session = model.db.session
+    state = sqlalchemy.inspect(real_time_update)
+    return (state.persistent or state.pending) and session.get_bind().dialect.name == "postgresql"
+
+
+def bulk_persist(real_time_update):
+    """
+    Persist the TripUpdates of a RealTimeUpdate (with their VehicleJourney, StopTimeUpdates and the association
+    with the RealTimeUpdate) with one multi-row statement per table, instead of the ORM's unit of work.
+
+    It has the same result as persist():
+        * the RealTimeUpdate is inserted if not stored yet (single transaction mode, see make_rt_update())
+        * new VehicleJourneys are inserted, new TripUpdates are inserted, modified ones are updated
+        * StopTimeUpdates removed from the TripUpdates are deleted (delete-orphan cascade),
+          new ones are inserted and modified ones are updated (with their current order),
+          unchanged ones are not written
+        * created_at/updated_at are filled as the ORM would
+
+    Then objects are put back in the session as if they were loaded from db (without any history),
+    so that the ORM doesn't write them again.
+    """
+    session = model.db.session
+    now = datetime.datetime.utcnow()
+    trip_updates = list(real_time_update.trip_updates)
+    is_rtu_new = _is_new(real_time_update)
+
+    new_vjs = []
+    stop_time_updates = []
+    # the ORM must not flush anything while objects are read
+    with session.no_autoflush:
+        for trip_update in trip_updates:
+            # foreign keys are only synchronized by the ORM during flush
+            trip_update.vj_id = trip_update.vj.id
+            if _is_new(trip_update.vj):
+                new_vjs.append(trip_update.vj)
+            for stu in trip_update.stop_time_updates:
+                stu.trip_update_id = trip_update.vj_id
+                stop_time_updates.append(stu)
+        rtu_rows = [_make_row(real_time_update, now)] if is_rtu_new else []
+        vj_rows = [_make_row(vj, now) for vj in new_vjs]
+        new_trip_update_rows = [_make_row(tu, now) for tu in trip_updates if _is_new(tu)]
+        modified_trip_update_rows = [
+            _make_row(tu, now) for tu in trip_updates if not _is_new(tu) and _is_modified(tu)
+        ]
+        new_stop_time_update_rows = [_make_row(stu, now) for stu in stop_time_updates if _is_new(stu)]
+        modified_stop_time_update_rows = [
+            _make_row(stu, now) for stu in stop_time_updates if not _is_new(stu) and _is_modified(stu)
+        ]
+
+    trip_update_ids = [tu.vj_id for tu in trip_updates]
+    cursor = session.connection().connection.cursor()
+    try:
+        _insert(cursor, RealTimeUpdate.__table__, rtu_rows)
+        _insert(cursor, VehicleJourney.__table__, vj_rows)
+        _insert(cursor, TripUpdate.__table__, new_trip_update_rows)
+        _update(cursor, TripUpdate.__table__, modified_trip_update_rows, key="vj_id")
+        if trip_update_ids:
+            cursor.execute(
+                "DELETE FROM stop_time_update "
+                "WHERE trip_update_id = ANY(%s::uuid[]) AND NOT (id = ANY(%s::uuid[]))",
+                (trip_update_ids, [stu.id for stu in stop_time_updates]),
+            )
+        _insert(cursor, StopTimeUpdate.__table__, new_stop_time_update_rows)
+        _update(cursor, StopTimeUpdate.__table__, modified_stop_time_update_rows, key="id")
+        _insert(
+            cursor,
+            associate_realtimeupdate_tripupdate,
+            [(real_time_update.id, trip_update_id) for trip_update_id in trip_update_ids],
+        )
+    finally:
+        cursor.close()
+
+    _mark_as_persisted(real_time_update, is_rtu_new, trip_updates, new_vjs, stop_time_updates)
+    session.commit()
+
+
+def _is_new(obj):
+    state = sqlalchemy.inspect(obj)
+    return state.transient or state.pending
+
+
+def _is_modified(obj):
+    """
+    :return: True if a persisted value of obj changed (assigning the same value is not a change)
+    """
+    state = sqlalchemy.inspect(obj)
+    return any(state.attrs[prop.key].history.has_changes() for prop in state.mapper.column_attrs)
+
+
+def _make_row(obj, now):
+    """
+    :return: tuple of obj's values, in the order of its table's columns.
+        Missing values are filled (on obj too) as the ORM would on insert (or update for updated_at).
+    """
+    state = sqlalchemy.inspect(obj)
+    is_new = _is_new(obj)
+    is_modified = is_new or _is_modified(obj)
+    row = []
+    for column in state.mapper.local_table.columns:
+        key = state.mapper.get_property_by_column(column).key
+        # expired values of objects from db are loaded
+        value = state.dict.get(key) if is_new else getattr(obj, key)
+        if key == "updated_at" and is_modified:
+            value = now
+        elif value is None and key == "created_at":
+            value = now
+        elif value is None and column.default is not None and column.default.is_scalar:
+            value = column.default.arg
+        elif value is None and column.default is not None and column.default.is_callable:
+            value = column.default.arg(None)
+        setattr(obj, key, value)
+        row.append(value)
+    return tuple(row)
+
+
+def _insert(cursor, table, rows):
+    """
+    Insert all rows in a single statement
+    """
+    if not rows:
+        return
+    query = "INSERT INTO {table} ({columns}) VALUES %s".format(
+        table=table.name, columns=", ".join('"{}"'.format(c.name) for c in table.columns)
+    )
+    execute_values(cursor, query, rows, page_size=len(rows))
+
+
+def _update(cursor, table, rows, key):
+    """
+    Update all rows (identified by their key column) in a single statement
+    (ON CONFLICT is not available before PostgreSQL 9.5)
+    """
+    if not rows:
+        return
+    columns = [c.name for c in table.columns]
+    # values are typed explicitly, as literals of a VALUES list are considered as text
+    dialect = postgresql.dialect()
+    template = "({})".format(", ".join("%s::{}".format(c.type.compile(dialect=dialect)) for c in table.columns))
+    query = (
+        'UPDATE {table} SET {updates} FROM (VALUES %s) AS v ({columns}) WHERE {table}."{key}" = v."{key}"'
+    ).format(
+        table=table.name,
+        updates=", ".join('"{c}" = v."{c}"'.format(c=c) for c in columns if c not in (key, "created_at")),
+        columns=", ".join('"{}"'.format(c) for c in columns),
+        key=key,
+    )
+    execute_values(cursor, query, rows, template=template, page_size=len(rows))
+
+
+def _mark_as_persisted(real_time_update, is_rtu_new, trip_updates, vjs, stop_time_updates):
+    """
+    Make the session consider written objects as loaded from db, without any pending change
+    """
+    session = model.db.session
+    written = set(trip_updates) | set(vjs) | set(stop_time_updates) | {tu.vj for tu in trip_updates}
+
+    # StopTimeUpdates removed from the TripUpdates were deleted in db, the ORM must not delete them again
+    trip_update_ids = {tu.vj_id for tu in trip_updates}
+    for obj in list(session.identity_map.values()):
+        if (
+            isinstance(obj, StopTimeUpdate)
+            and obj not in written
+            and sqlalchemy.inspect(obj).dict.get("trip_update_id") in trip_update_ids
+        ):
+            make_transient(obj)
+
+    for obj in written:
+        make_transient(obj)
+        make_transient_to_detached(obj)
+
+    if is_rtu_new:
+        # any other change of the RealTimeUpdate (like its status) was written with it
+        make_transient(real_time_update)
+        make_transient_to_detached(real_time_update)
+        session.add(real_time_update)
+    set_committed_value(real_time_update, "trip_updates", trip_updates)
+    session.add_all(trip_updates)  # VehicleJourneys and StopTimeUpdates are added by cascade
@@ -38,6 +38,7 @@ from collections import namedtuple
 import kirin
 from kirin import gtfs_realtime_pb2
 from kirin.core import model
+from kirin.core.bulk_persist import bulk_persist, can_bulk_persist
 from kirin.core.model import TripUpdate, StopTimeUpdate
 from kirin.core.populate_pb import convert_to_gtfsrt
 from kirin.exceptions import MessageNotPublished
@@ -50,7 +51,11 @@ TimeDelayTuple = namedtuple("TimeDelayTuple", ["time", "delay"])
 def persist(real_time_update):
     """
     receive a RealTimeUpdate and persist it in the database
+    (with multi-row statements if BULK_PERSISTENCE is activated, see bulk_persist())
     """
+    if kirin.app.config.get(str("BULK_PERSISTENCE")) and can_bulk_persist(real_time_update):
+        bulk_persist(real_time_update)
+        return
     model.db.session.add(real_time_update)
     model.db.session.commit()
 
@@ -158,14 +163,19 @@ def manage_consistency(trip_update):
     return True
 
 
-def find_st_in_vj(st_id, vj_sts):
+def _get_dated_vj_key(trip_update):
+    return trip_update.vj.navitia_trip_id, trip_update.vj.start_timestamp
+
+
+def index_by_dated_vj(trip_updates):
     """
-    Find a stop_time in the navitia vehicle journey
-    :param st_id: id of the requested stop_time
-    :param vj_sts: list of stop_times available in the vj
-    :return: stop_time if found else None
+    Index TripUpdates by (navitia_trip_id, start_timestamp) of their VehicleJourney
+    (keeping the first one if duplicated)
     """
-    return next((vj_st for vj_st in vj_sts if vj_st.get("stop_point", {}).get("id") == st_id), None)
+    res = {}
+    for tu in trip_updates:
+        res.setdefault(_get_dated_vj_key(tu), tu)
+    return res
 
 
 def handle(real_time_update, trip_updates, contributor_id, is_new_complete):
@@ -176,19 +186,11 @@ def handle(real_time_update, trip_updates, contributor_id, is_new_complete):
     """
     if not real_time_update:
         raise TypeError()
-    id_timestamp_tuples = [(tu.vj.navitia_trip_id, tu.vj.start_timestamp) for tu in trip_updates]
-    old_trip_updates = TripUpdate.find_by_dated_vjs(id_timestamp_tuples)
+    id_timestamp_tuples = [_get_dated_vj_key(tu) for tu in trip_updates]
+    old_trip_updates = index_by_dated_vj(TripUpdate.find_by_dated_vjs(id_timestamp_tuples))
     for trip_update in trip_updates:
         # find if there is already a row in db
-        old = next(
-            (
-                tu
-                for tu in old_trip_updates
-                if tu.vj.navitia_trip_id == trip_update.vj.navitia_trip_id
-                and tu.vj.start_timestamp == trip_update.vj.start_timestamp
-            ),
-            None,
-        )
+        old = old_trip_updates.get(_get_dated_vj_key(trip_update))
         # merge the base schedule, the current realtime, and the new realtime
         current_trip_update = merge(trip_update.vj.navitia_vj, old, trip_update, is_new_complete=is_new_complete)
 
@@ -198,11 +200,19 @@ def handle(real_time_update, trip_updates, contributor_id, is_new_complete):
             # this link is done quite late to avoid too soon persistence of trip_update by sqlalchemy
             current_trip_update.real_time_updates.append(real_time_update)
 
+    # After merging trip_updates information of connector realtime, navitia and kirin database, if there is no new
+    # information destined to navitia, update real_time_update with status = 'KO' and a proper error message.
+    # (this is done before persisting, so that it's committed along with everything else)
+    no_new_information = not real_time_update.trip_updates and real_time_update.status == "OK"
+    if no_new_information:
+        msg = "No new information destined to navitia for this {}".format(real_time_update.connector)
+        set_rtu_status_ko(real_time_update, msg, is_reprocess_same_data_allowed=False)
+
     persist(real_time_update)
 
     feed = convert_to_gtfsrt(real_time_update.trip_updates, gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL)
     feed_str = feed.SerializeToString()
-    publish(feed_str, contributor_id)
+    publish(feed_str, contributor_id, real_time_update.id)
 
     data_time = datetime.datetime.utcfromtimestamp(feed.header.timestamp)
     log_dict = {
@@ -211,16 +221,10 @@ def handle(real_time_update, trip_updates, contributor_id, is_new_complete):
         "trip_update_count": len(feed.entity),
         "size": len(feed_str),
     }
-    # After merging trip_updates information of connector realtime, navitia and kirin database, if there is no new
-    # information destined to navitia, update real_time_update with status = 'KO' and a proper error message.
-    if not real_time_update.trip_updates and real_time_update.status == "OK":
-        msg = "No new information destined to navitia for this {}".format(real_time_update.connector)
-        set_rtu_status_ko(real_time_update, msg, is_reprocess_same_data_allowed=False)
+    if no_new_information:
         logging.getLogger(__name__).warning(
-            "RealTimeUpdate id={}: {}".format(real_time_update.id, msg), extra=log_dict
+            "RealTimeUpdate id={}: {}".format(real_time_update.id, real_time_update.error), extra=log_dict
         )
-        model.db.session.add(real_time_update)
-        model.db.session.commit()
 
     return real_time_update, log_dict
 
@@ -469,7 +473,7 @@ def merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete):
             # Iterate on the new trip update stop_times if it is complete (all stop_times present in it)
             for order, new_stu in enumerate(new_trip_update.stop_time_updates):
                 # Find corresponding stop_time in the theoretical VJ
-                vj_st = find_st_in_vj(new_stu.stop_id, new_trip_update.vj.navitia_vj.get("stop_times", []))
+                vj_st = new_trip_update.vj.find_navitia_stop_time(new_stu.stop_id)
                 if vj_st:
                     yield order, vj_st
                 else:
@@ -514,6 +518,10 @@ def merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete):
         )
 
     has_changes = False
+    # StopTimeUpdates from db are kept in the result (updated if needed) so that their row in db is kept:
+    # only the modified stop_times are then written in db
+    reused_db_stus = set()
+    db_stus_to_update = {}  # new StopTimeUpdate -> db StopTimeUpdate to update with it
     previous_stop_event = TimeDelayTuple(time=None, delay=None)
     last_departure = None
     circulation_date = new_trip_update.vj.get_circulation_date()
@@ -590,8 +598,19 @@ def merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete):
             new_st_update = _make_stop_time_update(
                 base_arrival, base_departure, last_departure, new_st, navitia_stop["stop_point"], order=nav_order
             )
-            has_changes |= (db_st is None) or db_st.is_not_equal(new_st_update)
-            res_st = new_st_update if has_changes else db_st
+            # (a db StopTimeUpdate can be found for several stops in case of lollipop, it's reused only once)
+            if db_st is not None and db_st not in reused_db_stus:
+                reused_db_stus.add(db_st)
+                if db_st.is_not_equal(new_st_update):
+                    has_changes = True
+                    res_st = new_st_update
+                    # db_st is updated once all stops are processed, as db_trip_update is still read until then
+                    db_stus_to_update[new_st_update] = db_st
+                else:
+                    res_st = db_st
+            else:
+                has_changes |= (db_st is None) or db_st.is_not_equal(new_st_update)
+                res_st = new_st_update
 
         elif db_trip_update is None and new_st is not None:
             """
@@ -622,6 +641,8 @@ def merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete):
                 )
             )
             has_changes |= db_st is None
+            if db_st is not None:
+                reused_db_stus.add(db_st)
         else:
             """
             Last case: nothing is recorded yet and there is no update info in the new trip update
@@ -642,18 +663,24 @@ def merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete):
     res.effect = new_trip_update.effect
 
     if has_changes:
+        for i, res_st in enumerate(res_stoptime_updates):
+            db_st = db_stus_to_update.get(res_st)
+            if db_st is not None:
+                db_st.update_from(res_st)
+                res_stoptime_updates[i] = db_st
         res.stop_time_updates = res_stoptime_updates
         return res
 
     return None
 
 
-def publish(feed, contributor_id):
+def publish(feed, contributor_id, rt_update_id=None):
     """
     send RT feed to navitia
+    :param rt_update_id: id of the RealTimeUpdate the feed comes from
     """
     try:
-        kirin.rmq_handler.publish(feed, contributor_id)
+        kirin.rmq_handler.submit(feed, contributor_id, rt_update_id)
 
     except socket.error:
         logging.getLogger(__name__).exception(
@@ -36,6 +36,9 @@ from sqlalchemy.orm import backref, deferred
 from sqlalchemy.ext.orderinglist import ordering_list
 from flask_sqlalchemy import SQLAlchemy
 import datetime
+import logging
+import zlib
+import six
 import sqlalchemy
 from sqlalchemy import desc
 from kirin.core.types import ModificationType, TripEffect, ConnectorType
@@ -162,6 +165,21 @@ class VehicleJourney(db.Model):  # type: ignore
     def get_circulation_date(self):
         return self.start_timestamp.date()
 
+    def find_navitia_stop_time(self, stop_point_id):
+        """
+        Find the first stop_time of the navitia VJ served at the given stop_point
+        :param stop_point_id: id of the requested stop_point
+        :return: stop_time if found else None
+        """
+        # index is built once per VJ, and not persisted (as navitia_vj)
+        stop_times_by_stop_point_id = getattr(self, "_navitia_stop_times_by_stop_point_id", None)
+        if stop_times_by_stop_point_id is None:
+            stop_times_by_stop_point_id = {}
+            for vj_st in self.navitia_vj.get("stop_times", []):
+                stop_times_by_stop_point_id.setdefault(vj_st.get("stop_point", {}).get("id"), vj_st)
+            self._navitia_stop_times_by_stop_point_id = stop_times_by_stop_point_id
+        return stop_times_by_stop_point_id.get(stop_point_id)
+
 
 class StopTimeUpdate(db.Model, TimestampMixin):  # type: ignore
     """
@@ -250,6 +268,21 @@ class StopTimeUpdate(db.Model, TimestampMixin):  # type: ignore
             or self.arrival_status != other.arrival_status
         )
 
+    def update_from(self, other):
+        """
+        Copy other's information in self, keeping self's identity (and thus its row in db)
+        """
+        self.navitia_stop = getattr(other, "navitia_stop", None)
+        self.stop_id = other.stop_id
+        self.message = other.message
+        self.order = other.order
+        self.departure = other.departure
+        self.departure_delay = other.departure_delay
+        self.departure_status = other.departure_status
+        self.arrival = other.arrival
+        self.arrival_delay = other.arrival_delay
+        self.arrival_status = other.arrival_status
+
     def get_stop_event_status(self, event_name):
         if not hasattr(self, "{}_status".format(event_name)):
             raise Exception('StopTimeUpdate has no attribute "{}_status"'.format(event_name))
@@ -267,6 +300,7 @@ class StopTimeUpdate(db.Model, TimestampMixin):  # type: ignore
 associate_realtimeupdate_tripupdate = db.Table(
     "associate_realtimeupdate_tripupdate",
     db.metadata,
+    # not enforced in db while real_time_update is partitioned (see kirin.core.rtu_partitions)
     db.Column("real_time_update_id", postgresql.UUID, db.ForeignKey("real_time_update.id", ondelete="CASCADE")),
     db.Column("trip_update_id", postgresql.UUID, db.ForeignKey("trip_update.vj_id", ondelete="CASCADE")),
     db.PrimaryKeyConstraint(
@@ -388,16 +422,129 @@ class TripUpdate(db.Model, TimestampMixin):  # type: ignore
         return query.all()
 
     @classmethod
-    def remove_by_contributors_and_period(cls, contributors, start_date=None, end_date=None):
-        trip_updates_to_remove = cls.find_by_contributor_period(
-            contributors=contributors, start_date=start_date, end_date=end_date
+    def _query_vj_ids_by_contributor_period(cls, contributors, start_date=None, end_date=None):
+        """
+        Query of the vj_ids of TripUpdates of find_by_contributor_period()
+        """
+        query = (
+            db.session.query(cls.vj_id)
+            .join(VehicleJourney, cls.vj_id == VehicleJourney.id)
+            .filter(cls.contributor_id.in_(contributors))
         )
-        for t in trip_updates_to_remove:
-            f = sqlalchemy.text("associate_realtimeupdate_tripupdate.trip_update_id='{}'".format(t.vj_id))
-            db.session.query(associate_realtimeupdate_tripupdate).filter(f).delete(synchronize_session=False)
-            db.session.delete(t)
+        if start_date:
+            start_dt = datetime.datetime.combine(start_date, datetime.time(0, 0))
+            query = query.filter(VehicleJourney.start_timestamp >= start_dt)
+        if end_date:
+            end_dt = datetime.datetime.combine(end_date, datetime.time(0, 0)) + datetime.timedelta(days=1)
+            query = query.filter(VehicleJourney.start_timestamp <= end_dt)
+        return query
 
-        db.session.commit()
+    @classmethod
+    def stream_by_contributor_period(cls, contributors, start_date=None, end_date=None, batch_size=1000):
+        """
+        Generator of the TripUpdates of find_by_contributor_period(), without loading them all in memory:
+        ids are read through a server-side cursor and TripUpdates are loaded (and expunged from session once
+        consumed) by batches of batch_size.
+        (yield_per() cannot be used directly on TripUpdates as stop_time_updates are eagerly loaded by a join)
+        """
+        query = cls._query_vj_ids_by_contributor_period(contributors, start_date, end_date)
+        vj_ids_query = query.order_by(cls.vj_id).execution_options(stream_results=True).yield_per(batch_size)
+
+        def load_batch(vj_ids):
+            trip_updates = cls.query.filter(cls.vj_id.in_(vj_ids)).order_by(cls.vj_id).all()
+            for trip_update in trip_updates:
+                yield trip_update
+                db.session.expunge(trip_update)
+
+        vj_ids = []
+        for (vj_id,) in vj_ids_query:
+            vj_ids.append(vj_id)
+            if len(vj_ids) >= batch_size:
+                for trip_update in load_batch(vj_ids):
+                    yield trip_update
+                vj_ids = []
+        if vj_ids:
+            for trip_update in load_batch(vj_ids):
+                yield trip_update
+
+    @classmethod
+    def remove_by_contributors_and_period(cls, contributors, start_date=None, end_date=None, batch_size=None):
+        """
+        Delete the TripUpdates of find_by_contributor_period() with their StopTimeUpdates, VehicleJourneys
+        and links to RealTimeUpdates, without loading them:
+        vj_ids are read by ranges of batch_size (in vj_id order) and each range is purged with one set-based
+        DELETE per table, then committed (so locks are held for one batch only).
+
+        :param batch_size: number of TripUpdates purged by batch (PURGE_TRIP_UPDATE_BATCH_SIZE if None)
+        :return: list of the reports of each batch (rows purged by table and duration in seconds)
+        """
+        from kirin import app
+
+        if batch_size is None:
+            batch_size = app.config.get(str("PURGE_TRIP_UPDATE_BATCH_SIZE"), 1000)
+        vj_ids_query = cls._query_vj_ids_by_contributor_period(contributors, start_date, end_date)
+        # children first, so that no cascade has to be triggered
+        tables_to_purge = [
+            (associate_realtimeupdate_tripupdate, "trip_update_id"),
+            (StopTimeUpdate.__table__, "trip_update_id"),
+            (cls.__table__, "vj_id"),
+            (VehicleJourney.__table__, "id"),
+        ]
+        reports = []
+        last_vj_id = None
+        while True:
+            start_datetime = datetime.datetime.utcnow()
+            batch_query = vj_ids_query
+            if last_vj_id is not None:
+                batch_query = batch_query.filter(cls.vj_id > last_vj_id)
+            vj_ids = [vj_id for (vj_id,) in batch_query.order_by(cls.vj_id).limit(batch_size)]
+            if not vj_ids:
+                break
+
+            rows_purged = {}
+            for table, column in tables_to_purge:
+                result = db.session.execute(
+                    sqlalchemy.text(
+                        "DELETE FROM {table} USING unnest(CAST(:vj_ids AS uuid[])) AS purged(vj_id) "
+                        "WHERE {table}.{column} = purged.vj_id".format(table=table.name, column=column)
+                    ),
+                    {"vj_ids": vj_ids},
+                )
+                rows_purged[table.name] = result.rowcount
+            db.session.commit()
+
+            report = {
+                "contributors": contributors,
+                "batch": len(reports),
+                "first_vj_id": vj_ids[0],
+                "last_vj_id": vj_ids[-1],
+                "rows_purged": rows_purged,
+                "duration": (datetime.datetime.utcnow() - start_datetime).total_seconds(),
+            }
+            logging.getLogger(__name__).info("TripUpdates batch purged", extra=report)
+            reports.append(report)
+
+            last_vj_id = vj_ids[-1]
+            if len(vj_ids) < batch_size:
+                break
+        return reports
+
+    def _get_stop_index(self):
+        """
+        Index of stop_time_updates (not persisted), built on first lookup and reset as soon as
+        stop_time_updates changes (see _reset_stop_index()).
+        Keeps the first StopTimeUpdate by (stop_id, order) and by stop_id, as a linear scan would.
+        """
+        stop_index = getattr(self, "_stop_index", None)
+        if stop_index is None:
+            by_stop_id_and_order = {}
+            by_stop_id = {}
+            for st in self.stop_time_updates:
+                by_stop_id_and_order.setdefault((st.stop_id, st.order), st)
+                by_stop_id.setdefault(st.stop_id, st)
+            stop_index = (by_stop_id_and_order, by_stop_id)
+            self._stop_index = stop_index
+        return stop_index
 
     def find_stop(self, stop_id, order=None):
         # To handle a vj with the same stop served multiple times (lollipop) we search first with
@@ -405,10 +552,22 @@ class TripUpdate(db.Model, TimestampMixin):  # type: ignore
         # For COTS, since we don't care about the order, search only with stop_id if no element found
         # Note: if the trip_update stops list is not a strict ending sublist of stops list of navitia_vj
         # then the whole trip is ignored in model_maker.
-        first = next((st for st in self.stop_time_updates if st.stop_id == stop_id and st.order == order), None)
+        by_stop_id_and_order, by_stop_id = self._get_stop_index()
+        first = by_stop_id_and_order.get((stop_id, order))
         if first:
             return first
-        return next((st for st in self.stop_time_updates if st.stop_id == stop_id), None)
+        return by_stop_id.get(stop_id)
+
+
+@sqlalchemy.event.listens_for(TripUpdate.stop_time_updates, "append")
+@sqlalchemy.event.listens_for(TripUpdate.stop_time_updates, "remove")
+@sqlalchemy.event.listens_for(TripUpdate.stop_time_updates, "bulk_replace")
+@sqlalchemy.event.listens_for(TripUpdate, "refresh")
+def _reset_stop_index(target, *args):
+    """
+    Any change on TripUpdate.stop_time_updates invalidates the stop index used by find_stop()
+    """
+    target._stop_index = None
 
 
 class RealTimeUpdate(db.Model, TimestampMixin):  # type: ignore
@@ -427,7 +586,11 @@ class RealTimeUpdate(db.Model, TimestampMixin):  # type: ignore
     status = db.Column(db.Enum("OK", "KO", "pending", name="rt_status"), nullable=False)
     db.Index("status_idx", status)
     error = db.Column(db.Text, nullable=True)
-    raw_data = deferred(db.Column(db.Text, nullable=True))
+    # raw data is stored either as text or compressed (see RT_UPDATE_RAW_DATA_COMPRESSION), use property raw_data
+    _raw_data = deferred(db.Column("raw_data", db.Text, nullable=True), group="raw_data")
+    _raw_data_compressed = deferred(
+        db.Column("raw_data_compressed", db.LargeBinary, nullable=True), group="raw_data"
+    )
     contributor_id = db.Column(db.Text, db.ForeignKey("contributor.id"), nullable=False)
 
     trip_updates = db.relationship(
@@ -451,6 +614,42 @@ class RealTimeUpdate(db.Model, TimestampMixin):  # type: ignore
         self.error = error
         self.contributor_id = contributor_id
 
+    @property
+    def raw_data(self):
+        """
+        Raw data as text (UTF-8), whatever the way it's stored.
+        Use raw_data_bytes for binary raw data (like a GTFS-RT protobuf).
+        """
+        if self._raw_data_compressed is None:
+            return self._raw_data
+        return zlib.decompress(self._raw_data_compressed).decode("utf-8", "replace")
+
+    @raw_data.setter
+    def raw_data(self, raw_data):
+        from kirin import app
+
+        if raw_data is None or not app.config.get(str("RT_UPDATE_RAW_DATA_COMPRESSION")):
+            self._raw_data = raw_data
+            self._raw_data_compressed = None
+            return
+        if isinstance(raw_data, six.text_type):
+            raw_data = raw_data.encode("utf-8")
+        self._raw_data = None
+        self._raw_data_compressed = zlib.compress(
+            raw_data, app.config.get(str("RT_UPDATE_RAW_DATA_COMPRESSION_LEVEL"), 6)
+        )
+
+    @property
+    def raw_data_bytes(self):
+        """
+        Raw data as bytes (text is UTF-8 encoded), whatever the way it's stored
+        """
+        if self._raw_data_compressed is not None:
+            return zlib.decompress(self._raw_data_compressed)
+        if isinstance(self._raw_data, six.text_type):
+            return self._raw_data.encode("utf-8")
+        return self._raw_data
+
     @classmethod
     def get_probes_by_contributor(cls):
         """
@@ -504,6 +703,30 @@ class RealTimeUpdate(db.Model, TimestampMixin):  # type: ignore
 
     @classmethod
     def remove_by_connectors_until(cls, connectors, until):
+        """
+        Delete the RealTimeUpdates of connectors created until the given date, if not linked to any TripUpdate.
+        If real_time_update is partitioned (see kirin.core.rtu_partitions), the partitions of the days before
+        are dropped instead (the RealTimeUpdates linked to a TripUpdate being moved to the default partition
+        beforehand), and partitions of the next days are created.
+        """
+        from kirin import app
+        from kirin.core import rtu_partitions
+
+        if rtu_partitions.is_partitioned(db.session):
+            today = datetime.datetime.utcnow().date()
+            next_days = [
+                today + timedelta(days=d)
+                for d in range(app.config.get(str("RT_UPDATE_PARTITIONS_AHEAD_DAYS"), 3))
+            ]
+            for connector in connectors:
+                rtu_partitions.create_connector_partition(db.session, connector)  # if missing
+                dropped = rtu_partitions.drop_daily_partitions_until(db.session, connector, until)
+                created = rtu_partitions.create_daily_partitions(db.session, connector, next_days)
+                logging.getLogger(__name__).info(
+                    "real_time_update partitions of %s: dropped %s, created %s", connector, dropped, created
+                )
+
+        # the remaining rows (all rows if not partitioned, rows of default partitions otherwise)
         sub_query = (
             db.session.query(cls.id)
             .outerjoin(associate_realtimeupdate_tripupdate)
@@ -511,7 +734,10 @@ class RealTimeUpdate(db.Model, TimestampMixin):  # type: ignore
             .filter(cls.created_at <= until)
             .filter(associate_realtimeupdate_tripupdate.c.real_time_update_id == None)
         )  # '==' works, not 'is'
-        cls.query.filter(cls.id.in_(sub_query)).delete(synchronize_session=False)
+        # filters are repeated for partition pruning
+        cls.query.filter(cls.connector.in_(connectors)).filter(cls.created_at <= until).filter(
+            cls.id.in_(sub_query)
+        ).delete(synchronize_session=False)
 
         db.session.commit()
 
@@ -563,6 +789,20 @@ class Contributor(db.Model):  # type: ignore
         self.exchange_name = exchange_name
         self.queue_name = queue_name
 
+    def config_fingerprint(self):
+        # type: () -> int
+        """
+        Fingerprint of the contributor's configuration: it changes as soon as one of its fields changes
+        """
+        return hash(tuple(getattr(self, column.key) for column in self.__table__.columns))
+
+    def copy(self):
+        # type: () -> Contributor
+        """
+        :return: a copy of the contributor, not attached to any session (so its fields never expire)
+        """
+        return Contributor(**{column.key: getattr(self, column.key) for column in self.__table__.columns})
+
     @classmethod
     def find_by_connector_type(cls, type, include_deactivated=False):
         if include_deactivated:
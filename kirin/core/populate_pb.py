@@ -33,6 +33,7 @@ from __future__ import absolute_import, print_function, unicode_literals, divisi
 from kirin import gtfs_realtime_pb2, kirin_pb2
 from kirin.core.types import stop_time_status_to_protobuf, ModificationType
 import datetime
+from collections import OrderedDict
 
 
 def date_to_str(date):
@@ -60,6 +61,52 @@ def convert_to_gtfsrt(trip_updates, incrementality=gtfs_realtime_pb2.FeedHeader.
     return feed
 
 
+def convert_to_gtfsrt_chunks(
+    trip_updates, incrementality=gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL, max_size=None
+):
+    """
+    Same as convert_to_gtfsrt(), but generates several FeedMessages (sharing the same header),
+    each one being at most max_size bytes once serialized (unless a single entity is bigger).
+    At least one FeedMessage is generated (empty if there is no trip_update).
+    """
+    feed = convert_to_gtfsrt([], incrementality)
+    header = gtfs_realtime_pb2.FeedHeader()
+    header.CopyFrom(feed.header)
+    header_size = feed.ByteSize()
+    size = header_size
+    for trip_update in trip_updates:
+        entity = gtfs_realtime_pb2.FeedEntity()
+        fill_entity(entity, trip_update)
+        # entity's size + upper bound of its field key and length prefix
+        entity_size = entity.ByteSize() + 6
+        if max_size and feed.entity and size + entity_size > max_size:
+            yield feed
+            feed = gtfs_realtime_pb2.FeedMessage()
+            feed.header.CopyFrom(header)
+            size = header_size
+        feed.entity.add().CopyFrom(entity)
+        size += entity_size
+    yield feed
+
+
+def merge_differential_feeds(feeds):
+    """
+    Merge DIFFERENTIAL FeedMessages (from the oldest to the newest) into a single one.
+    Each entity contains the whole trip, so only the newest version of an entity is kept.
+    The header of the newest feed is used.
+    """
+    merged = gtfs_realtime_pb2.FeedMessage()
+    merged.header.CopyFrom(feeds[-1].header)
+    entities = OrderedDict()
+    for feed in feeds:
+        for entity in feed.entity:
+            # moved at the end, as the newest feed is the last one published
+            entities.pop(entity.id, None)
+            entities[entity.id] = entity
+    merged.entity.extend(entities.values())
+    return merged
+
+
 def get_st_event(st_status):
     if st_status in ("delete", "deleted_for_detour"):
         return gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED
@@ -0,0 +1,303 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+import datetime
+
+import sqlalchemy
+
+# Time partitioning of table real_time_update (opt-in, see commands partition_rt_update/unpartition_rt_update).
+# real_time_update is partitioned by connector (LIST), each connector's partition being partitioned by day
+# of created_at (RANGE, UTC), with a default partition for rows of a day without partition.
+# Purging the old RealTimeUpdates of a connector then consists in dropping partitions.
+# As when purging a regular table, RealTimeUpdates linked to TripUpdates are kept.
+# The foreign key from associate_realtimeupdate_tripupdate to real_time_update (declared in the model) is
+# dropped while real_time_update is partitioned, as the primary key of a partitioned table has to include
+# partition keys: links are only deleted with their TripUpdates then, and the foreign key is re-created
+# when unpartitioning.
+# All functions take a connection (or a session) and don't commit.
+
+PARENT_TABLE = "real_time_update"
+PARTITION_DAY_FORMAT = "%Y%m%d"
+MIN_SERVER_VERSION_NUM = 110000  # declarative partitioning with default partitions requires PostgreSQL >= 11
+ASSOCIATION_FOREIGN_KEY = "associate_realtimeupdate_tripupdate_real_time_update_id_fkey"
+INDEXES = [
+    ("status_idx", "status"),
+    ("realtime_update_created_at", "created_at"),
+    ("realtime_update_contributor_id_and_created_at", "created_at, contributor_id"),
+]
+
+
+def is_partitioning_supported(connection):
+    return int(connection.execute("SHOW server_version_num").scalar()) >= MIN_SERVER_VERSION_NUM
+
+
+def is_partitioned(connection):
+    """
+    :return: True if real_time_update is a partitioned table
+    """
+    return (
+        connection.execute(
+            sqlalchemy.text("SELECT relkind FROM pg_class WHERE relname = :table_name"),
+            {"table_name": PARENT_TABLE},
+        ).scalar()
+        == "p"
+    )
+
+
+def connector_partition_name(connector):
+    # type: (unicode) -> unicode
+    return "{}_{}".format(PARENT_TABLE, connector.replace("-", "_"))
+
+
+def daily_partition_name(connector, day):
+    # type: (unicode, datetime.date) -> unicode
+    return "{}_{}".format(connector_partition_name(connector), day.strftime(PARTITION_DAY_FORMAT))
+
+
+def default_partition_name(connector):
+    # type: (unicode) -> unicode
+    return "{}_default".format(connector_partition_name(connector))
+
+
+def get_partitions(connection, table_name):
+    """
+    :return: names of the partitions of the table
+    """
+    rows = connection.execute(
+        sqlalchemy.text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = :table_name"
+        ),
+        {"table_name": table_name},
+    )
+    return {name for (name,) in rows}
+
+
+def create_connector_partition(connection, connector):
+    """
+    Create the partition of a connector (partitioned by day), and its default partition
+    """
+    connection.execute(
+        sqlalchemy.text(
+            "CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {parent} FOR VALUES IN (:connector) "
+            "PARTITION BY RANGE (created_at)".format(
+                partition=connector_partition_name(connector), parent=PARENT_TABLE
+            )
+        ),
+        {"connector": connector},
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS {default} PARTITION OF {partition} DEFAULT".format(
+            default=default_partition_name(connector), partition=connector_partition_name(connector)
+        )
+    )
+
+
+def create_daily_partitions(connection, connector, days):
+    """
+    Create the missing partitions of a connector for the given days.
+    Rows of these days already received by the default partition are moved into the new partitions.
+    :return: names of the partitions created
+    """
+    connector_partition = connector_partition_name(connector)
+    existing_partitions = get_partitions(connection, connector_partition)
+    created = []
+    for day in sorted(set(days)):
+        partition = daily_partition_name(connector, day)
+        if partition in existing_partitions:
+            continue
+        bounds = {
+            "start": datetime.datetime.combine(day, datetime.time(0, 0)),
+            "end": datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time(0, 0)),
+        }
+        connection.execute(
+            "CREATE TABLE {partition} (LIKE {parent} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)".format(
+                partition=partition, parent=PARENT_TABLE
+            )
+        )
+        connection.execute(
+            sqlalchemy.text(
+                "WITH moved AS ("
+                "  DELETE FROM {default} WHERE created_at >= :start AND created_at < :end RETURNING *"
+                ") INSERT INTO {partition} SELECT * FROM moved".format(
+                    default=default_partition_name(connector), partition=partition
+                )
+            ),
+            bounds,
+        )
+        connection.execute(
+            sqlalchemy.text(
+                "ALTER TABLE {connector_partition} ATTACH PARTITION {partition} "
+                "FOR VALUES FROM (:start) TO (:end)".format(
+                    connector_partition=connector_partition, partition=partition
+                )
+            ),
+            bounds,
+        )
+        created.append(partition)
+    return created
+
+
+def drop_daily_partitions_until(connection, connector, until):
+    """
+    Drop the partitions of a connector whose day is entirely before until.
+    The RealTimeUpdates linked to TripUpdates are kept: they are moved to the default partition of the
+    connector (so the cost only depends on the number of linked rows, which are few as TripUpdates are purged).
+    :return: names of the partitions dropped
+    """
+    connector_partition = connector_partition_name(connector)
+    prefix = "{}_".format(connector_partition)
+    dropped = []
+    for partition in sorted(get_partitions(connection, connector_partition)):
+        try:
+            day = datetime.datetime.strptime(partition[len(prefix) :], PARTITION_DAY_FORMAT).date()
+        except ValueError:
+            continue  # default partition
+        if day >= until:
+            continue
+        connection.execute(
+            "ALTER TABLE {connector_partition} DETACH PARTITION {partition}".format(
+                connector_partition=connector_partition, partition=partition
+            )
+        )
+        # without the partition of their day, rows are inserted in the default partition
+        connection.execute(
+            "INSERT INTO {parent} SELECT * FROM {partition} WHERE id IN "
+            "(SELECT real_time_update_id FROM associate_realtimeupdate_tripupdate)".format(
+                parent=PARENT_TABLE, partition=partition
+            )
+        )
+        connection.execute("DROP TABLE {}".format(partition))
+        dropped.append(partition)
+    return dropped
+
+
+def partition_real_time_update(connection, ahead_days):
+    """
+    Rebuild real_time_update as a partitioned table (rows are copied, so it may take a while on a big table)
+    :param ahead_days: number of daily partitions created from today
+    """
+    if is_partitioned(connection):
+        return
+    if not is_partitioning_supported(connection):
+        raise Exception("partitioning of real_time_update requires PostgreSQL >= 11")
+
+    # the current table is kept aside (without its indexes) until its rows are copied
+    connection.execute("ALTER TABLE real_time_update RENAME TO real_time_update_unpartitioned")
+    connection.execute(
+        "ALTER TABLE real_time_update_unpartitioned "
+        "RENAME CONSTRAINT real_time_update_pkey TO real_time_update_unpartitioned_pkey"
+    )
+    for index_name, _ in INDEXES:
+        connection.execute("DROP INDEX IF EXISTS {}".format(index_name))
+
+    connection.execute(
+        "CREATE TABLE real_time_update (LIKE real_time_update_unpartitioned INCLUDING DEFAULTS) "
+        "PARTITION BY LIST (connector)"
+    )
+    # unique constraints of a partitioned table must include partition keys
+    connection.execute(
+        "ALTER TABLE real_time_update "
+        "ADD CONSTRAINT real_time_update_pkey PRIMARY KEY (id, connector, created_at)"
+    )
+    connection.execute(
+        "ALTER TABLE real_time_update ADD CONSTRAINT fk_real_time_update_contributor_id "
+        "FOREIGN KEY (contributor_id) REFERENCES contributor(id)"
+    )
+    connection.execute("CREATE INDEX real_time_update_id_idx ON real_time_update (id)")
+    for index_name, columns in INDEXES:
+        connection.execute("CREATE INDEX {} ON real_time_update ({})".format(index_name, columns))
+
+    today = datetime.datetime.utcnow().date()
+    next_days = [today + datetime.timedelta(days=d) for d in range(ahead_days)]
+    connectors = [c for (c,) in connection.execute("SELECT unnest(enum_range(NULL::connector_type))::text")]
+    for connector in connectors:
+        create_connector_partition(connection, connector)
+        days = [
+            day
+            for (day,) in connection.execute(
+                sqlalchemy.text(
+                    "SELECT DISTINCT created_at::date FROM real_time_update_unpartitioned "
+                    "WHERE connector = :connector"
+                ),
+                {"connector": connector},
+            )
+        ]
+        create_daily_partitions(connection, connector, days + next_days)
+
+    connection.execute("INSERT INTO real_time_update SELECT * FROM real_time_update_unpartitioned")
+    # also drops the foreign key from associate_realtimeupdate_tripupdate
+    connection.execute("DROP TABLE real_time_update_unpartitioned CASCADE")
+
+
+def unpartition_real_time_update(connection):
+    """
+    Rebuild real_time_update as a regular table (rows are copied, so it may take a while on a big table)
+    """
+    if not is_partitioned(connection):
+        return
+
+    connection.execute("ALTER TABLE real_time_update RENAME TO real_time_update_partitioned")
+    connection.execute(
+        "ALTER TABLE real_time_update_partitioned "
+        "RENAME CONSTRAINT real_time_update_pkey TO real_time_update_partitioned_pkey"
+    )
+    connection.execute("DROP INDEX IF EXISTS real_time_update_id_idx")
+    for index_name, _ in INDEXES:
+        connection.execute("DROP INDEX IF EXISTS {}".format(index_name))
+
+    connection.execute("CREATE TABLE real_time_update (LIKE real_time_update_partitioned INCLUDING DEFAULTS)")
+    connection.execute("INSERT INTO real_time_update SELECT * FROM real_time_update_partitioned")
+    connection.execute("DROP TABLE real_time_update_partitioned CASCADE")
+
+    connection.execute("ALTER TABLE real_time_update ADD CONSTRAINT real_time_update_pkey PRIMARY KEY (id)")
+    connection.execute(
+        "ALTER TABLE real_time_update ADD CONSTRAINT fk_real_time_update_contributor_id "
+        "FOREIGN KEY (contributor_id) REFERENCES contributor(id)"
+    )
+    for index_name, columns in INDEXES:
+        connection.execute("CREATE INDEX {} ON real_time_update ({})".format(index_name, columns))
+
+    # links to RealTimeUpdates deleted without foreign key (there shouldn't be any)
+    connection.execute(
+        "DELETE FROM associate_realtimeupdate_tripupdate "
+        "WHERE real_time_update_id NOT IN (SELECT id FROM real_time_update)"
+    )
+    connection.execute(
+        "ALTER TABLE associate_realtimeupdate_tripupdate ADD CONSTRAINT {} "
+        "FOREIGN KEY (real_time_update_id) REFERENCES real_time_update(id) ON DELETE CASCADE".format(
+            ASSOCIATION_FOREIGN_KEY
+        )
+    )
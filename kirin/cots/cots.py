@@ -33,10 +33,12 @@ from __future__ import absolute_import, print_function, unicode_literals, divisi
 import flask
 from flask.globals import current_app
 import logging
+import threading
 
 from flask_restful import Resource
 
 from kirin.core.abstract_builder import wrap_build
+from kirin.core.builder_cache import get_builder, IntervalCheck
 from kirin.cots import KirinModelBuilder
 from kirin.exceptions import InvalidArguments, SubServiceError
 from kirin.core import model
@@ -73,6 +75,45 @@ def get_cots_contributor(include_deactivated=False):
         return contributor[0]
 
 
+class _CachedContributor(object):
+    def __init__(self, contributor):
+        self.contributor = contributor
+        self.check = IntervalCheck()
+
+
+# process-wide cache of the COTS contributor from db (a copy, see get_cached_cots_contributor())
+_cached_cots_contributor = None
+_cached_cots_contributor_lock = threading.Lock()
+
+
+def get_cached_cots_contributor():
+    """
+    :return: the COTS contributor (see get_cots_contributor()).
+        The one from db is copied (see Contributor.copy()) and kept COTS_CONTRIBUTOR_CACHE_TTL seconds
+        in the process, so that it is not requested for each feed.
+    """
+    global _cached_cots_contributor
+    if current_app.config.get(str("COTS_CONTRIBUTOR")):
+        return get_cots_contributor()
+
+    with _cached_cots_contributor_lock:
+        cached = _cached_cots_contributor
+    if cached is not None and not cached.check.is_due(
+        current_app.config.get(str("COTS_CONTRIBUTOR_CACHE_TTL"), 60)
+    ):
+        return cached.contributor
+    contributor = get_cots_contributor().copy()
+    with _cached_cots_contributor_lock:
+        _cached_cots_contributor = _CachedContributor(contributor)
+    return contributor
+
+
+def clear_cots_contributor_cache():
+    global _cached_cots_contributor
+    with _cached_cots_contributor_lock:
+        _cached_cots_contributor = None
+
+
 def get_cots(req):
     """
     get COTS stream, for the moment, it's the raw json
@@ -83,11 +124,11 @@ def get_cots(req):
 
 
 class Cots(Resource):
-    def __init__(self):
-        self.builder = KirinModelBuilder(get_cots_contributor())
-
     def post(self):
         raw_json = get_cots(flask.globals.request)
 
-        wrap_build(self.builder, raw_json)
+        # resources are instantiated for each request: the contributor and the builder are taken from
+        # process-wide caches (see get_cached_cots_contributor() and get_builder())
+        builder = get_builder(KirinModelBuilder, get_cached_cots_contributor())
+        wrap_build(builder, raw_json)
         return "OK", 200
@@ -28,22 +28,45 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 from __future__ import absolute_import, print_function, unicode_literals, division
+import hashlib
 import logging
+import threading
+import time
 
 import pybreaker
 import requests as requests
 import six
 
 from kirin import app
-
+from kirin.core.builder_cache import IntervalCheck
 from kirin.exceptions import ObjectNotFound, UnauthorizedOnSubService, SubServiceError
 
-
 cots_message_breaker = pybreaker.CircuitBreaker(
     fail_max=app.config[str("COTS_PAR_IV_CIRCUIT_BREAKER_MAX_FAIL")],
     reset_timeout=app.config[str("COTS_PAR_IV_CIRCUIT_BREAKER_TIMEOUT_S")],
 )
 
+# background refreshes of the message referential (stale-while-revalidate mode), by cache key
+_refresh_threads = {}
+# last background refresh attempts (successful or not), by cache key
+_refresh_attempts = {}
+_refresh_threads_lock = threading.Lock()
+
+
+def make_message_handler():
+    """
+    :return: a MessageHandler configured with the COTS_PAR_IV_* settings
+    """
+    return MessageHandler(
+        api_key=app.config[str("COTS_PAR_IV_API_KEY")],
+        resource_server=app.config[str("COTS_PAR_IV_MOTIF_RESOURCE_SERVER")],
+        token_server=app.config[str("COTS_PAR_IV_TOKEN_SERVER")],
+        client_id=app.config[str("COTS_PAR_IV_CLIENT_ID")],
+        client_secret=app.config[str("COTS_PAR_IV_CLIENT_SECRET")],
+        grant_type=app.config[str("COTS_PAR_IV_GRANT_TYPE")],
+        timeout=app.config[str("COTS_PAR_IV_REQUEST_TIMEOUT")],
+    )
+
 
 class MessageHandler:
     """
@@ -143,8 +166,7 @@ class MessageHandler:
                 messages[m["id"]] = m["labelExt"]
         return messages
 
-    @app.cache.memoize(timeout=app.config.get(str("COTS_PAR_IV_CACHE_TIMEOUT"), 60 * 60))
-    def _call_webservice_safer(self):
+    def _fetch_messages(self):
         try:
             return self._call_webservice()
         except UnauthorizedOnSubService:
@@ -152,10 +174,88 @@ class MessageHandler:
             app.cache.delete_memoized(MessageHandler._get_access_token)
             return self._call_webservice()
 
+    @app.cache.memoize(timeout=app.config.get(str("COTS_PAR_IV_CACHE_TIMEOUT"), 60 * 60))
+    def _call_webservice_safer(self):
+        return self._fetch_messages()
+
+    def _messages_cache_key(self):
+        # repr() contains spaces and '<>', rejected in keys by some cache backends (like memcached)
+        return "cots_par_iv_messages.{}".format(hashlib.sha1(repr(self).encode("utf-8")).hexdigest())
+
+    def refresh_messages(self):
+        """
+        Request the message referential and cache it with its refresh time (stale-while-revalidate mode).
+        It is kept in cache COTS_PAR_IV_CACHE_MAX_STALE seconds after its expiration,
+        to be served while it's refreshed.
+        """
+        messages = cots_message_breaker.call(self._fetch_messages)
+        timeout = app.config.get(str("COTS_PAR_IV_CACHE_TIMEOUT"), 60 * 60) + app.config.get(
+            str("COTS_PAR_IV_CACHE_MAX_STALE"), 60 * 60
+        )
+        app.cache.set(self._messages_cache_key(), (messages, time.time()), timeout=timeout)
+        return messages
+
+    def _refresh_messages_in_background(self):
+        key = self._messages_cache_key()
+        retry_interval = app.config.get(str("COTS_PAR_IV_CACHE_REFRESH_RETRY_INTERVAL"), 60)
+        with _refresh_threads_lock:
+            if key in _refresh_threads and _refresh_threads[key].is_alive():
+                return  # already being refreshed
+            # a failed refresh (like when the circuit breaker is open) is not attempted again right away
+            if key not in _refresh_attempts:
+                _refresh_attempts[key] = IntervalCheck()
+            elif not _refresh_attempts[key].is_due(retry_interval):
+                return
+            thread = threading.Thread(target=self._background_refresh_messages)
+            thread.daemon = True
+            _refresh_threads[key] = thread
+        thread.start()
+
+    def _background_refresh_messages(self):
+        try:
+            with app.app_context():
+                self.refresh_messages()
+        except Exception as e:
+            # the cached referential is still served, next request will try again
+            logging.getLogger(__name__).warning(
+                "COTS cause message sub-service, background refresh failed: {}".format(six.text_type(e))
+            )
+
+    def _get_messages_stale_while_revalidate(self):
+        """
+        Serve the cached message referential, refreshing it in background COTS_PAR_IV_CACHE_REFRESH_AHEAD
+        seconds before its expiration (or once expired).
+        The referential is only requested synchronously if there is none in cache.
+        """
+        cached = app.cache.get(self._messages_cache_key())
+        if cached is None:
+            return self.refresh_messages()
+        messages, refreshed_at = cached
+        refresh_after = app.config.get(str("COTS_PAR_IV_CACHE_TIMEOUT"), 60 * 60) - app.config.get(
+            str("COTS_PAR_IV_CACHE_REFRESH_AHEAD"), 5 * 60
+        )
+        if time.time() - refreshed_at >= refresh_after:
+            self._refresh_messages_in_background()
+        return messages
+
+    def _get_messages(self):
+        if app.config.get(str("COTS_PAR_IV_CACHE_STALE_WHILE_REVALIDATE")):
+            return self._get_messages_stale_while_revalidate()
+        return cots_message_breaker.call(self._call_webservice_safer)
+
+    def warm_messages(self):
+        """
+        Load the message referential in cache
+        :return: the message referential
+        """
+        if app.config.get(str("COTS_PAR_IV_CACHE_STALE_WHILE_REVALIDATE")):
+            return self.refresh_messages()
+        return cots_message_breaker.call(self._call_webservice_safer)
+
     def get_message(self, index):
         if self.token_server and self.resource_server:
             try:
-                return cots_message_breaker.call(self._call_webservice_safer).get(index)
+                return self._get_messages().get(index)
             except pybreaker.CircuitBreakerError as e:
                 logging.getLogger(__name__).error(
                     "COTS cause message sub-service handling error : "
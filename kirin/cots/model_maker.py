@@ -32,10 +32,13 @@
 from __future__ import absolute_import, print_function, unicode_literals, division
 
 import logging
+import re
+import threading
+from collections import OrderedDict
 from datetime import datetime
+from functools import partial
 from operator import itemgetter
 
-import jmespath
 from dateutil import parser
 from flask.globals import current_app
 from pytz import utc
@@ -46,9 +49,16 @@ import ujson
 
 from kirin.core import model
 from kirin.core.abstract_builder import AbstractKirinModelBuilder
-from kirin.cots.message_handler import MessageHandler
+from kirin.core.builder_cache import PublicationDateWatcher
+from kirin.cots.message_handler import make_message_handler
 from kirin.exceptions import InvalidArguments, InternalException, ObjectNotFound
-from kirin.utils import record_internal_failure, make_rt_update, to_navitia_utc_str
+from kirin.utils import (
+    record_internal_failure,
+    make_rt_update,
+    to_navitia_utc_str,
+    run_concurrently,
+    get_navitia_concurrency,
+)
 from kirin.core.types import (
     TripEffect,
     ModificationType,
@@ -108,15 +118,32 @@ def headsigns(str_headsign):
     return [signs[0], alternative_headsign]
 
 
-def get_navitia_stop_time_sncf(cr, ci, ch, nav_vj):
+def make_navitia_stop_times_by_sncf_code(nav_vj):
+    """
+    Index the stop_times of a navitia VJ by the CR-CI-CH code(s) of their stop_area
+    :param nav_vj: json dict of navitia's VJ
+    :return: dict of CR-CI-CH code to the list of stop_times (in VJ's order) whose stop_area has this code
+    """
+    res = {}
+    for nav_st in nav_vj.get("stop_times", []):
+        stop_area = (nav_st.get("stop_point") or {}).get("stop_area") or {}
+        for code in stop_area.get("codes") or []:
+            if code.get("type") != "CR-CI-CH":
+                continue
+            nav_stop_times = res.setdefault(code.get("value"), [])
+            # a stop_time is listed once for a code, even if its stop_area has this code multiple times
+            if not nav_stop_times or nav_stop_times[-1] is not nav_st:
+                nav_stop_times.append(nav_st)
+    return res
+
+
+def get_navitia_stop_time_sncf(cr, ci, ch, nav_stop_times_by_code):
+    """
+    :param nav_stop_times_by_code: index of the VJ's stop_times (see make_navitia_stop_times_by_sncf_code())
+    """
     nav_external_code = "{cr}-{ci}-{ch}".format(cr=cr, ci=ci, ch=ch)
 
-    nav_stop_times = jmespath.search(
-        "stop_times[? stop_point.stop_area.codes[? value==`{nav_ext_code}` && type==`CR-CI-CH`]]".format(
-            nav_ext_code=nav_external_code
-        ),
-        nav_vj,
-    )
+    nav_stop_times = nav_stop_times_by_code.get(nav_external_code)
 
     log_dict = None
     if not nav_stop_times:
@@ -167,6 +194,16 @@ def _retrieve_interesting_pdp(list_pdp):
     res = []
     picked_one = False
     sorted_list_pdp = sorted(list_pdp, key=itemgetter("rang"))
+
+    # has_following_arrival[idx] is True if a station at or after idx has an arrival time
+    has_following_arrival = [False] * len(sorted_list_pdp)
+    following_arrival_found = False
+    for idx in reversed(range(len(sorted_list_pdp))):
+        follow_pdp = sorted_list_pdp[idx]
+        if get_value(follow_pdp, "horaireVoyageurArrivee", nullable=True) and is_station(follow_pdp):
+            following_arrival_found = True
+        has_following_arrival[idx] = following_arrival_found
+
     for idx, pdp in enumerate(sorted_list_pdp):
         # At start, do not consume until there's a departure time (horaireVoyageurDepart)
         if not picked_one and not get_value(pdp, "horaireVoyageurDepart", nullable=True):
@@ -186,20 +223,66 @@ def _retrieve_interesting_pdp(list_pdp):
         # * if no stop_time has arrival time anymore, then stop_times are useless as traveler cannot
         #   hop off, so no point hopping in anymore, so we remove all the stop_times until the end
         #   (should not happen in practice).
-        if not get_value(pdp, "horaireVoyageurArrivee", nullable=True):
-            has_following_arrival = any(
-                get_value(follow_pdp, "horaireVoyageurArrivee", nullable=True) and is_station(follow_pdp)
-                for follow_pdp in sorted_list_pdp[idx:]
-            )
-            if not has_following_arrival:
-                break
+        if not get_value(pdp, "horaireVoyageurArrivee", nullable=True) and not has_following_arrival[idx]:
+            break
 
         picked_one = True
         res.append(pdp)
     return res
 
 
+# COTS datetimes are always formatted like "2018-09-01T12:02:00+0200"
+COTS_DATETIME_REGEX = re.compile(r"^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})([+-])(\d{2}):?(\d{2})$")
+COTS_DATETIME_CACHE_SIZE = 512
+_cots_datetime_cache = OrderedDict()  # LRU cache of parsed COTS datetimes
+_cots_datetime_cache_lock = threading.Lock()  # builders may run in several threads
+
+
+def _parse_cots_utc_naive_dt(str_time):
+    """
+    Fast parsing of COTS datetime format (with offset), returns None if str_time has another format
+
+    >>> _parse_cots_utc_naive_dt("2018-09-01T12:02:00+0200")
+    datetime.datetime(2018, 9, 1, 10, 2)
+    >>> _parse_cots_utc_naive_dt("2018-09-01T00:30:00-01:30")
+    datetime.datetime(2018, 9, 1, 2, 0)
+    >>> _parse_cots_utc_naive_dt("2018-09-01T12:02:00")
+
+    >>> _parse_cots_utc_naive_dt("2018-13-01T12:02:00+0000")
+
+    """
+    match = COTS_DATETIME_REGEX.match(str_time)
+    if not match:
+        return None
+    year, month, day, hour, minute, second, sign, offset_hours, offset_minutes = match.groups()
+    try:
+        dt = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+    except ValueError:
+        return None
+    offset = timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+    return dt - offset if sign == "+" else dt + offset
+
+
 def as_utc_naive_dt(str_time):
+    with _cots_datetime_cache_lock:
+        res = _cots_datetime_cache.pop(str_time, None)
+        if res is not None:
+            _cots_datetime_cache[str_time] = res
+            return res
+    # parsing is done outside of the lock
+    res = _parse_cots_utc_naive_dt(str_time) or _parse_utc_naive_dt(str_time)
+    with _cots_datetime_cache_lock:
+        _cots_datetime_cache.pop(str_time, None)  # may have been added by another thread meanwhile
+        if len(_cots_datetime_cache) >= COTS_DATETIME_CACHE_SIZE:
+            _cots_datetime_cache.popitem(last=False)  # drop least recently used
+        _cots_datetime_cache[str_time] = res
+    return res
+
+
+def _parse_utc_naive_dt(str_time):
+    """
+    Generic (and slow) parsing of datetime, for unexpected formats
+    """
     try:
         return (
             parser.parse(str_time, dayfirst=False, yearfirst=True, ignoretz=False)
@@ -358,18 +441,46 @@ def _get_action_on_trip(train_numbers, dict_version, pdps):
     return action_on_trip
 
 
+# process-wide cache of navitia's referential objects (companies, physical_modes, stop_points by CR-CI-CH),
+# by navitia instance url: {url: _NavitiaReferential}
+_navitia_referentials = {}
+_navitia_referentials_lock = threading.Lock()
+
+
+class _NavitiaReferential(object):
+    def __init__(self, navitia):
+        self.publication_date_watcher = PublicationDateWatcher(navitia)
+        self.objects = {}
+
+
+def _get_navitia_referential(navitia):
+    """
+    :return: the _NavitiaReferential of the navitia instance, emptied if navitia's publication date changed
+        (checked every COTS_REFERENTIAL_CACHE_PUBDATE_CHECK_INTERVAL seconds)
+    """
+    with _navitia_referentials_lock:
+        referential = _navitia_referentials.get(navitia.url)
+    if referential is None:
+        referential = _NavitiaReferential(navitia)
+        with _navitia_referentials_lock:
+            referential = _navitia_referentials.setdefault(navitia.url, referential)
+    elif not referential.publication_date_watcher.is_up_to_date(
+        navitia, current_app.config.get(str("COTS_REFERENTIAL_CACHE_PUBDATE_CHECK_INTERVAL"), 60)
+    ):
+        with _navitia_referentials_lock:
+            referential.objects.clear()
+    return referential
+
+
+def clear_navitia_referential_cache():
+    with _navitia_referentials_lock:
+        _navitia_referentials.clear()
+
+
 class KirinModelBuilder(AbstractKirinModelBuilder):
     def __init__(self, contributor):
         super(KirinModelBuilder, self).__init__(contributor, is_new_complete=True)
-        self.message_handler = MessageHandler(
-            api_key=current_app.config[str("COTS_PAR_IV_API_KEY")],
-            resource_server=current_app.config[str("COTS_PAR_IV_MOTIF_RESOURCE_SERVER")],
-            token_server=current_app.config[str("COTS_PAR_IV_TOKEN_SERVER")],
-            client_id=current_app.config[str("COTS_PAR_IV_CLIENT_ID")],
-            client_secret=current_app.config[str("COTS_PAR_IV_CLIENT_SECRET")],
-            grant_type=current_app.config[str("COTS_PAR_IV_GRANT_TYPE")],
-            timeout=current_app.config[str("COTS_PAR_IV_REQUEST_TIMEOUT")],
-        )
+        self.message_handler = make_message_handler()
 
     def build_rt_update(self, input_raw):
         rt_update = make_rt_update(
@@ -389,10 +500,10 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         (see fixtures and documentation)
         """
         # assuming UTF-8 encoding for all input
-        rt_update.raw_data = rt_update.raw_data.encode("utf-8")
+        raw_json = rt_update.raw_data_bytes
 
         try:
-            json = ujson.loads(rt_update.raw_data)
+            json = ujson.loads(raw_json)
         except ValueError as e:
             raise InvalidArguments("invalid json: {}".format(e.message))
 
@@ -410,7 +521,9 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
 
         action_on_trip = _get_action_on_trip(train_numbers, dict_version, pdps)
         vjs = self._get_vjs(train_numbers, pdps, action_on_trip=action_on_trip)
-        trip_updates = [self._make_trip_update(dict_version, vj, action_on_trip=action_on_trip) for vj in vjs]
+        trip_updates = [
+            self._make_trip_update(dict_version, vj, pdps, action_on_trip=action_on_trip) for vj in vjs
+        ]
 
         log_dict = {}
         return trip_updates, log_dict
@@ -442,20 +555,27 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         if not (projected_departure >= projected_arrival >= last_stop_time_depart):
             raise InvalidArguments("invalid cots: stop_point's({}) time is not consistent".format(pdp_code))
 
-    def _make_trip_update(self, json_train, vj, action_on_trip=ActionOnTrip.NOT_ADDED.name):
+    def _make_trip_update(self, json_train, vj, pdps, action_on_trip=ActionOnTrip.NOT_ADDED.name):
         """
         create the new TripUpdate object
         Following the COTS spec: https://github.com/CanalTP/kirin/blob/master/documentation/cots_connector.md
+        :param pdps: interesting "Points de Parcours" of json_train (see _retrieve_interesting_pdp())
         """
         trip_update = model.TripUpdate(vj=vj, contributor_id=self.contributor.id)
         trip_message_id = get_value(json_train, "idMotifInterneReference", nullable=True)
         if trip_message_id:
             trip_update.message = self.message_handler.get_message(index=trip_message_id)
         cots_company_id = get_value(json_train, "codeCompagnieTransporteur", nullable=True) or DEFAULT_COMPANY_ID
-        trip_update.company_id = self._get_navitia_company(cots_company_id)
-
         trip_status = get_value(json_train, "statutOperationnel")
 
+        # company and physical_mode lookups are independent: they are overlapped (see NAVITIA_CONCURRENCY)
+        navitia_lookups = [partial(self._get_navitia_company, cots_company_id)]
+        if trip_status != TripStatus.SUPPRIMEE.name and action_on_trip != ActionOnTrip.NOT_ADDED.name:
+            cots_physical_mode = get_value(json_train, "indicateurFer", nullable=True)
+            navitia_lookups.append(partial(self._get_navitia_physical_mode, cots_physical_mode))
+        navitia_results = run_concurrently(navitia_lookups, contributor_id=self.contributor.id)
+        trip_update.company_id = navitia_results[0]
+
         if trip_status == TripStatus.SUPPRIMEE.name:
             # the whole trip is deleted
             trip_update.status = ModificationType.delete.name
@@ -467,8 +587,7 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
             # the trip is created from scratch
             trip_update.effect = TripEffect.ADDITIONAL_SERVICE.name
             trip_update.status = ModificationType.add.name
-            cots_physical_mode = get_value(json_train, "indicateurFer", nullable=True)
-            trip_update.physical_mode_id = self._get_navitia_physical_mode(cots_physical_mode)
+            trip_update.physical_mode_id = navitia_results[1]
             trip_update.headsign = get_value(json_train, "numeroCourse", nullable=True)
 
         # all other status is considered an 'update' of the trip_update and effect is calculated
@@ -481,16 +600,22 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
 
         # Initialize stop_time status to nochange
         highest_st_status = ModificationType.none.name
-        pdps = _retrieve_interesting_pdp(get_value(json_train, "listePointDeParcours"))
 
         # this variable is used to memoize the last stop_time's departure in order to check the stop_time consistency
         # ex. stop_time[i].arrival/departure must be greater than stop_time[i-1].departure
         last_stop_time_depart = None
 
+        # CR-CI-CH codes of the VJ's stops are indexed once, to be matched with each pdp
+        nav_stop_times_by_code = make_navitia_stop_times_by_sncf_code(vj.navitia_vj)
+        requested_stop_points = None
+        if get_navitia_concurrency(self.contributor.id) > 1:
+            # missing stop_points are requested concurrently upfront (lazily otherwise)
+            requested_stop_points = self._request_missing_navitia_stop_points(pdps, nav_stop_times_by_code)
+
         # manage realtime information stop_time by stop_time
         for pdp in pdps:
             # retrieve navitia's stop_point corresponding to the current COTS pdp
-            nav_stop, log_dict = self._get_navitia_stop_point(pdp, vj.navitia_vj)
+            nav_stop, log_dict = self._get_navitia_stop_point(pdp, nav_stop_times_by_code, requested_stop_points)
             projected_stop_time = {"Arrivee": None, "Depart": None}  # used to check consistency
 
             if log_dict:
@@ -633,24 +758,26 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         # but most of the time (if not always) they refer to the same VJ
         # (the VJ switches headsign along the way).
         # So we do one VJ search for each headsign to ensure we get it, then deduplicate VJs
-        for train_number in headsigns(headsign_str):
-
-            log.debug(
-                "searching for vj {} during period [{} - {}] in navitia".format(
-                    train_number, extended_since_dt, extended_until_dt
+        train_numbers = list(headsigns(headsign_str))
+        # searches for each headsign are independent: they are overlapped (see NAVITIA_CONCURRENCY)
+        navitia_responses = run_concurrently(
+            [
+                partial(
+                    self.navitia.vehicle_journeys,
+                    q={
+                        "headsign": train_number,
+                        "since": to_navitia_utc_str(extended_since_dt),
+                        "until": to_navitia_utc_str(extended_until_dt),
+                        "depth": "2",  # we need this depth to get the stoptime's stop_area
+                        "show_codes": "true",  # we need the stop_points CRCICH codes
+                    },
                 )
-            )
-
-            navitia_vjs = self.navitia.vehicle_journeys(
-                q={
-                    "headsign": train_number,
-                    "since": to_navitia_utc_str(extended_since_dt),
-                    "until": to_navitia_utc_str(extended_until_dt),
-                    "depth": "2",  # we need this depth to get the stoptime's stop_area
-                    "show_codes": "true",  # we need the stop_points CRCICH codes
-                }
-            )
+                for train_number in train_numbers
+            ],
+            contributor_id=self.contributor.id,
+        )
 
+        for train_number, navitia_vjs in zip(train_numbers, navitia_responses):
             # Consistency check on action applied to trip
             if action_on_trip == ActionOnTrip.NOT_ADDED.name:
                 if not navitia_vjs:
@@ -683,29 +810,75 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
 
         return vjs.values()
 
-    def _get_navitia_stop_point(self, pdp, nav_vj):
+    def _request_missing_navitia_stop_points(self, pdps, nav_stop_times_by_code):
+        """
+        Request (concurrently, see NAVITIA_CONCURRENCY) navitia for the stop_points of the pdps
+        that are not served by the vj (typically additional stop_times)
+        :return: dict of the results of _request_navitia_stop_point() by (cr, ci, ch)
+        """
+        missing_codes = []
+        for pdp in pdps:
+            code = tuple(get_value(pdp, key, nullable=True) for key in ["cr", "ci", "ch"])
+            if None in code or code in missing_codes:
+                continue  # errors on pdp without code are raised when processing the pdp
+            if "{}-{}-{}".format(*code) not in nav_stop_times_by_code:
+                missing_codes.append(code)
+
+        results = run_concurrently(
+            [partial(self._request_navitia_stop_point, *code) for code in missing_codes],
+            contributor_id=self.contributor.id,
+        )
+        return dict(zip(missing_codes, results))
+
+    def _get_navitia_stop_point(self, pdp, nav_stop_times_by_code, requested_stop_points=None):
         """
         Get a navitia stop point from the stop_time in a 'Point de Parcours' dict.
         The dict MUST contain cr, ci, ch tags.
         It searches in the vj's stops for a stop_area with the external code cr-ci-ch
+        (using the index provided by make_navitia_stop_times_by_sncf_code())
 
         If the stop_time isn't found in the vj, in case of an additional stop_time,
-        a request is made to Navitia.
+        a request is made to Navitia (unless its result is already in requested_stop_points).
 
         Error messages are also returned as 'missing stop point', 'duplicate stops'
         """
+        cr, ci, ch = get_value(pdp, "cr"), get_value(pdp, "ci"), get_value(pdp, "ch")
         nav_st, log_dict = get_navitia_stop_time_sncf(
-            cr=get_value(pdp, "cr"), ci=get_value(pdp, "ci"), ch=get_value(pdp, "ch"), nav_vj=nav_vj
+            cr=cr, ci=ci, ch=ch, nav_stop_times_by_code=nav_stop_times_by_code
         )
         if not nav_st:
-            nav_stop, log_dict = self._request_navitia_stop_point(
-                cr=get_value(pdp, "cr"), ci=get_value(pdp, "ci"), ch=get_value(pdp, "ch")
-            )
+            if requested_stop_points and (cr, ci, ch) in requested_stop_points:
+                nav_stop, log_dict = requested_stop_points[(cr, ci, ch)]
+            else:
+                nav_stop, log_dict = self._request_navitia_stop_point(cr=cr, ci=ci, ch=ch)
         else:
             nav_stop = nav_st.get("stop_point", None)
         return nav_stop, log_dict
 
+    def _get_referential_object(self, key, request):
+        """
+        Get an object of navitia's referential from request(), or from the process-wide cache
+        if COTS_REFERENTIAL_CACHE is activated (the result is cached until navitia's publication date changes)
+        :param key: key of the object in the cache, like ("company", code)
+        :param request: function requesting navitia for the object
+        """
+        if not current_app.config.get(str("COTS_REFERENTIAL_CACHE")):
+            return request()
+        referential = _get_navitia_referential(self.navitia)
+        with _navitia_referentials_lock:
+            if key in referential.objects:
+                return referential.objects[key]
+        result = request()
+        with _navitia_referentials_lock:
+            referential.objects[key] = result
+        return result
+
     def _request_navitia_stop_point(self, cr, ci, ch):
+        return self._get_referential_object(
+            ("stop_point", cr, ci, ch), partial(self._request_navitia_stop_point_uncached, cr, ci, ch)
+        )
+
+    def _request_navitia_stop_point_uncached(self, cr, ci, ch):
         external_code = "{}-{}-{}".format(cr, ci, ch)
         stop_points = self.navitia.stop_points(
             q={"filter": 'stop_area.has_code("CR-CI-CH", "{}")'.format(external_code), "count": "1"}
@@ -721,7 +894,10 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         If the company doesn't exist in navitia, another request is made to
         find company for key="RefProd" and value="1187"
         """
-        return self._request_navitia_company(code) or self._request_navitia_company(DEFAULT_COMPANY_ID)
+        return self._get_referential_object(
+            ("company", code),
+            lambda: self._request_navitia_company(code) or self._request_navitia_company(DEFAULT_COMPANY_ID),
+        )
 
     def _request_navitia_company(self, code):
         companies = self.navitia.companies(
@@ -737,7 +913,10 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         If the physical_mode doesn't exist in navitia, another request is made default physical_mode
         with filter=physical_mode.id=physical_mode:LongDistanceTrain
         """
-        return self._request_navitia_physical_mode(indicator) or self._request_navitia_physical_mode()
+        return self._get_referential_object(
+            ("physical_mode", indicator),
+            lambda: self._request_navitia_physical_mode(indicator) or self._request_navitia_physical_mode(),
+        )
 
     def _request_navitia_physical_mode(self, indicator=None):
         physical_modes = self.navitia.physical_modes(q={"filter": get_mode_filter(indicator), "count": "1"})
@@ -36,6 +36,7 @@ from flask.globals import current_app
 from flask_restful import Resource, abort
 
 from kirin.core.abstract_builder import wrap_build
+from kirin.core.builder_cache import get_builder
 from kirin.exceptions import InvalidArguments
 import navitia_wrapper
 from kirin.gtfs_rt import KirinModelBuilder
@@ -118,5 +119,5 @@ class GtfsRT(Resource):
 
         raw_proto = _get_gtfs_rt(flask.globals.request)
 
-        wrap_build(KirinModelBuilder(contributor), raw_proto)
+        wrap_build(get_builder(KirinModelBuilder, contributor), raw_proto)
         return {"message": "GTFS-RT feed processed"}, 200
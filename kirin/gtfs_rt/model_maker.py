@@ -30,9 +30,12 @@
 # www.navitia.io
 from __future__ import absolute_import, print_function, unicode_literals, division
 import datetime
+import hashlib
 import logging
+from functools import partial
 
 import six
+from six.moves.urllib.parse import quote
 from google.protobuf.text_format import Parse as ParseProtoText, ParseError
 from google.protobuf.message import DecodeError
 
@@ -42,8 +45,9 @@ from kirin.core.abstract_builder import AbstractKirinModelBuilder
 from kirin.core.types import ModificationType, get_higher_status, get_effect_by_stop_time_status, ConnectorType
 from kirin.exceptions import InternalException, InvalidArguments
 from kirin.utils import make_rt_update, floor_datetime, to_navitia_utc_str, set_rtu_status_ko, manage_db_error
-from kirin.utils import record_internal_failure
-from kirin import app
+from kirin.utils import record_internal_failure, run_concurrently, build_redis_entity_hashes_key
+from kirin import app, redis_client
+from redis.exceptions import ConnectionError
 import itertools
 import calendar
 
@@ -73,7 +77,12 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
             )
             return rt_update, log_dict
 
-        feed = six.binary_type(proto)  # temp, for the moment, we save the protobuf as text
+        if app.config.get(str("GTFS_RT_STORE_RAW_PROTOBUF")) and app.config.get(
+            str("RT_UPDATE_RAW_DATA_COMPRESSION")
+        ):
+            feed = input_raw  # binary storage of raw data
+        else:
+            feed = six.binary_type(proto)  # temp, for the moment, we save the protobuf as text
         rt_update = make_rt_update(
             feed, connector_type=self.contributor.connector_type, contributor_id=self.contributor.id
         )
@@ -107,26 +116,116 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
 
         trip_updates = []
 
-        for entity in proto.entity:
-            if not entity.trip_update:
-                continue
-            tu = self._make_trip_updates(entity.trip_update, input_data_time=input_data_time)
+        input_trip_updates = [entity.trip_update for entity in proto.entity if entity.trip_update]
+        unchanged_count = 0
+        if app.config.get(str("GTFS_RT_ENTITY_DIFFING")):
+            input_trip_updates, unchanged_count = self._filter_unchanged_trip_updates(
+                rt_update, input_trip_updates
+            )
+            log_dict.update({"unchanged_trip_update_count": unchanged_count})
+
+        if app.config.get(str("GTFS_RT_VJ_BATCH_RESOLUTION")):
+            trip_ids = [input_trip_update.trip.trip_id for input_trip_update in input_trip_updates]
+            self._prefetch_navitia_vjs(trip_ids, input_data_time=input_data_time)
+
+        # VJ searches are independent from one another: they are overlapped (see NAVITIA_CONCURRENCY)
+        vjs_by_trip_update = run_concurrently(
+            [
+                partial(self._get_navitia_vjs, input_trip_update.trip, input_data_time=input_data_time)
+                for input_trip_update in input_trip_updates
+            ],
+            contributor_id=self.contributor.id,
+        )
+        for input_trip_update, vjs in zip(input_trip_updates, vjs_by_trip_update):
+            tu = self._make_trip_updates(input_trip_update, vjs, input_data_time=input_data_time)
             trip_updates.extend(tu)
+            if not tu and getattr(rt_update, "entity_hashes", None):
+                # processed again in the next feeds (navitia may then find its VJ, for example)
+                rt_update.entity_hashes.pop(_make_entity_key(input_trip_update), None)
 
-        if not trip_updates:
+        # if entities are only unchanged ones, handle() reports there is no new information
+        if not trip_updates and not unchanged_count:
             msg = "No information for this gtfs-rt with timestamp: {}".format(proto.header.timestamp)
             set_rtu_status_ko(rt_update, msg, is_reprocess_same_data_allowed=False)
             self.log.warning(msg)
 
-        log_dict = {}
         return trip_updates, log_dict
 
+    def on_rt_update_handled(self, rt_update):
+        """
+        Store the hashes of the entities of the feed handled, to compare the next feed with
+        (see _filter_unchanged_trip_updates())
+        """
+        entity_hashes = getattr(rt_update, "entity_hashes", None)
+        if entity_hashes is None:
+            return
+        hashes_key = build_redis_entity_hashes_key(self.contributor.id)
+        try:
+            # the expiration is not renewed, so that all entities are processed again regularly
+            remaining_ttl = redis_client.ttl(hashes_key)
+            ttl = (
+                remaining_ttl
+                if remaining_ttl and remaining_ttl > 0
+                else app.config.get(str("GTFS_RT_ENTITY_DIFFING_TTL"), 3600)
+            )
+            pipe = redis_client.pipeline()
+            pipe.delete(hashes_key)
+            if entity_hashes:
+                pipe.hmset(hashes_key, entity_hashes)
+                pipe.expire(hashes_key, ttl)
+            pipe.execute()
+        except ConnectionError:
+            self.log.exception("Exception with redis while storing entity hashes")
+
+    def _filter_unchanged_trip_updates(self, rt_update, input_trip_updates):
+        """
+        Keep only the trip updates of the feed that are new or changed since the last feed handled.
+        Trip updates missing from the feed are not considered as removed (DIFFERENTIAL semantics):
+        their previous realtime is kept.
+        The hashes of the feed's trip updates are kept in rt_update, to be stored once it is handled
+        (only for the trip updates producing TripUpdates, see build_trip_updates()).
+        :return: trip updates to process, number of unchanged trip updates
+        """
+        entity_hashes = {}
+        duplicated_keys = set()
+        for input_trip_update in input_trip_updates:
+            key = _make_entity_key(input_trip_update)
+            if key in entity_hashes:
+                duplicated_keys.add(key)
+            entity_hashes[key] = self._make_entity_hash(input_trip_update)
+        for key in duplicated_keys:
+            del entity_hashes[key]  # a trip updated by several entities of the feed is always processed
+        rt_update.entity_hashes = entity_hashes
+
+        try:
+            previous_hashes = redis_client.hgetall(build_redis_entity_hashes_key(self.contributor.id))
+        except ConnectionError:
+            self.log.exception("Exception with redis while reading entity hashes")
+            return input_trip_updates, 0
+
+        changed_trip_updates = []
+        for input_trip_update in input_trip_updates:
+            key = _make_entity_key(input_trip_update)
+            if key not in entity_hashes or previous_hashes.get(key) != entity_hashes[key]:
+                changed_trip_updates.append(input_trip_update)
+        return changed_trip_updates, len(input_trip_updates) - len(changed_trip_updates)
+
+    def _make_entity_hash(self, input_trip_update):
+        """
+        Hash of the content of a trip update, depending on navitia's data too (as the result of its processing)
+        """
+        trip_update = gtfs_realtime_pb2.TripUpdate()
+        trip_update.CopyFrom(input_trip_update)
+        trip_update.ClearField(str("timestamp"))  # a newer measure of the same information is not a change
+        content = "{}|".format(self.instance_data_pub_date).encode("utf-8") + trip_update.SerializeToString()
+        return hashlib.sha1(content).hexdigest()
+
     def _get_stop_code(self, nav_stop):
         for c in nav_stop.get("codes", []):
             if c["type"] == self.stop_code_key:
                 return c["value"]
 
-    def _make_trip_updates(self, input_trip_update, input_data_time):
+    def _make_trip_updates(self, input_trip_update, vjs, input_data_time):
         """
         If trip_update.stop_time_updates is not a strict ending subset of vj.stop_times we reject the trip update
         On the other hand:
@@ -134,8 +233,8 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         informations with that of navitia stop
         2. For the first stop point absent in trip_update.stop_time_updates we create a stop_time_update
         with no delay for that stop
+        :param vjs: kirin VJs matching input_trip_update (see _get_navitia_vjs())
         """
-        vjs = self._get_navitia_vjs(input_trip_update.trip, input_data_time=input_data_time)
         trip_updates = []
         for vj in vjs:
             trip_update = model.TripUpdate(vj=vj, contributor_id=self.contributor.id)
@@ -210,13 +309,22 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
             raise InternalException("Invalid datetime provided: must be naive (and UTC)")
         navitia_vjs = self.navitia.vehicle_journeys(
             q={
-                "filter": "vehicle_journey.has_code({}, {})".format(self.stop_code_key, vj_source_code),
+                "filter": self._make_vj_filter(vj_source_code),
                 "since": to_navitia_utc_str(since_dt),
                 "until": to_navitia_utc_str(until_dt),
                 "depth": "2",  # we need this depth to get the stoptime's stop_area
             }
         )
+        return self._make_vjs_from_navitia(navitia_vjs, vj_source_code, since_dt, until_dt)
 
+    def _make_vj_filter(self, vj_source_code):
+        return "vehicle_journey.has_code({}, {})".format(self.stop_code_key, vj_source_code)
+
+    def _make_vjs_from_navitia(self, navitia_vjs, vj_source_code, since_dt, until_dt):
+        """
+        Create the kirin VJ from navitia's vehicle journeys found for the given code in the period provided
+        :return: a list containing the VJ, empty if no VJ or too many VJs were found
+        """
         if not navitia_vjs:
             self.log.info(
                 "impossible to find vj {t} on [{s}, {u}]".format(t=vj_source_code, s=since_dt, u=until_dt)
@@ -244,11 +352,85 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
             record_internal_failure("Error while creating kirin VJ", contributor=self.contributor.id)
             return []
 
+    def _prefetch_navitia_vjs(self, vj_source_codes, input_data_time):
+        """
+        Search for navitia's vehicle journeys of multiple codes at once (filters combined with 'or'),
+        and fill the cache of _make_db_vj() with the VJs found for each code.
+        Codes already in cache are not searched again.
+        Filters are split in multiple requests to fit navitia's URL limits.
+        """
+        since_dt, until_dt = self._get_search_period(input_data_time)
+        make_db_vj = KirinModelBuilder._make_db_vj
+        cache_keys = {}
+        codes_to_search = []
+        for vj_source_code in vj_source_codes:
+            if vj_source_code in cache_keys:
+                continue
+            cache_key = make_db_vj.make_cache_key(make_db_vj.uncached, self, vj_source_code, since_dt, until_dt)
+            cache_keys[vj_source_code] = cache_key
+            if app.cache.get(cache_key) is None:
+                codes_to_search.append(vj_source_code)
+
+        max_filter_length = app.config.get(str("GTFS_RT_VJ_BATCH_FILTER_MAX_LENGTH"), 1500)
+        batch = []
+        batch_filter_length = 0
+        for vj_source_code in codes_to_search:
+            filter_length = len(quote(self._make_vj_filter(vj_source_code).encode("utf-8"))) + len(quote(" or "))
+            if batch and batch_filter_length + filter_length > max_filter_length:
+                self._prefetch_navitia_vjs_batch(batch, cache_keys, since_dt, until_dt)
+                batch = []
+                batch_filter_length = 0
+            batch.append(vj_source_code)
+            batch_filter_length += filter_length
+        if batch:
+            self._prefetch_navitia_vjs_batch(batch, cache_keys, since_dt, until_dt)
+
+    def _prefetch_navitia_vjs_batch(self, vj_source_codes, cache_keys, since_dt, until_dt):
+        self.log.debug(
+            "searching for {} vjs on [{}, {}] in navitia".format(len(vj_source_codes), since_dt, until_dt)
+        )
+        # VJs may share a code (they are then rejected), so some room is left to detect it
+        count = 2 * len(vj_source_codes)
+        try:
+            navitia_vjs = self.navitia.vehicle_journeys(
+                q={
+                    "filter": " or ".join(self._make_vj_filter(c) for c in vj_source_codes),
+                    "since": to_navitia_utc_str(since_dt),
+                    "until": to_navitia_utc_str(until_dt),
+                    "depth": "2",  # we need this depth to get the stoptime's stop_area
+                    "show_codes": "true",  # we need the VJ's codes to dispatch them
+                    "count": six.text_type(count),
+                }
+            )
+        except Exception as e:
+            # VJs will simply be searched one by one
+            self.log.warning("error while searching for multiple vjs in navitia: {}".format(e))
+            return
+
+        if len(navitia_vjs) >= count:
+            # response may be truncated: VJs will be searched one by one
+            return
+
+        navitia_vjs_by_code = {c: [] for c in vj_source_codes}
+        for nav_vj in navitia_vjs:
+            for code in nav_vj.get("codes", []):
+                if code.get("type") == self.stop_code_key and code.get("value") in navitia_vjs_by_code:
+                    navitia_vjs_by_code[code.get("value")].append(nav_vj)
+
+        make_db_vj = KirinModelBuilder._make_db_vj
+        for vj_source_code, code_navitia_vjs in navitia_vjs_by_code.items():
+            vjs = self._make_vjs_from_navitia(code_navitia_vjs, vj_source_code, since_dt, until_dt)
+            app.cache.set(cache_keys[vj_source_code], vjs, timeout=make_db_vj.cache_timeout)
+
+    def _get_search_period(self, input_data_time):
+        since_dt = floor_datetime(input_data_time - self.period_filter_tolerance)
+        until_dt = floor_datetime(input_data_time + self.period_filter_tolerance + datetime.timedelta(hours=1))
+        return since_dt, until_dt
+
     def _get_navitia_vjs(self, trip, input_data_time):
         vj_source_code = trip.trip_id
 
-        since_dt = floor_datetime(input_data_time - self.period_filter_tolerance)
-        until_dt = floor_datetime(input_data_time + self.period_filter_tolerance + datetime.timedelta(hours=1))
+        since_dt, until_dt = self._get_search_period(input_data_time)
         self.log.debug("searching for vj {} on [{}, {}] in navitia".format(vj_source_code, since_dt, until_dt))
 
         return self._make_db_vj(vj_source_code, since_dt, until_dt)
@@ -287,3 +469,10 @@ def _make_stoptime_update(input_st_update, nav_stop):
     )
 
     return st_update
+
+
+def _make_entity_key(input_trip_update):
+    """
+    Key identifying the trip of a GTFS-RT trip update from a feed to the next one
+    """
+    return hashlib.sha1(input_trip_update.trip.SerializeToString()).hexdigest()
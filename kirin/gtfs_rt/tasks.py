@@ -38,6 +38,7 @@ import six
 
 from kirin.core import model
 from kirin.core.abstract_builder import wrap_build
+from kirin.core.builder_cache import get_builder
 from kirin.core.types import ConnectorType
 from kirin.cots.model_maker import as_duration
 
@@ -57,7 +58,6 @@ from retrying import retry
 from kirin import app, redis_client
 from kirin import new_relic
 
-
 TASK_STOP_MAX_DELAY = app.config[str("TASK_STOP_MAX_DELAY")]
 TASK_WAIT_FIXED = app.config[str("TASK_WAIT_FIXED")]
 
@@ -169,5 +169,5 @@ def gtfs_poller(self, config):
             logger.debug(six.text_type(e))
             return
 
-        wrap_build(KirinModelBuilder(contributor), response.content)
+        wrap_build(get_builder(KirinModelBuilder, contributor), response.content)
         logger.info("%s for %s is finished", func_name, contributor.id)
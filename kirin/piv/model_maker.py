@@ -59,10 +59,10 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         The TripUpdates are not associated with the RealTimeUpdate at this point
         """
         # assuming UTF-8 encoding for all input
-        rt_update.raw_data = rt_update.raw_data.encode("utf-8")
+        raw_json = rt_update.raw_data_bytes
 
         try:
-            json = ujson.loads(rt_update.raw_data)
+            json = ujson.loads(raw_json)
         except ValueError as e:
             raise InvalidArguments("invalid json: {}".format(e.message))
 
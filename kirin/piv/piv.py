@@ -36,6 +36,7 @@ from flask.globals import current_app
 from flask_restful import Resource, marshal, abort
 
 from kirin.core.abstract_builder import wrap_build
+from kirin.core.builder_cache import get_builder
 from kirin.exceptions import InvalidArguments
 from kirin.core import model
 from kirin.core.types import ConnectorType
@@ -95,5 +96,5 @@ class Piv(Resource):
 
         raw_json = _get_piv(flask.globals.request)
 
-        wrap_build(KirinModelBuilder(contributor), raw_json)
+        wrap_build(get_builder(KirinModelBuilder, contributor), raw_json)
         return {"message": "PIV feed processed"}, 200
@@ -31,20 +31,34 @@
 
 from __future__ import absolute_import, print_function, unicode_literals, division
 
+import os
+from collections import OrderedDict
+
 import six
 from kombu import BrokerConnection, Exchange, Queue, Producer
 import logging
 from amqp.exceptions import ConnectionForced
 import gevent
 from retrying import retry
-from kirin import task_pb2, gtfs_realtime_pb2
+from kirin import app, task_pb2, gtfs_realtime_pb2
 from google.protobuf.message import DecodeError
 import socket
+import threading
+import time
+from kirin import new_relic
 from kirin.core.model import TripUpdate, db
-from kirin.core.populate_pb import convert_to_gtfsrt
-from kirin.utils import str_to_date, record_call
+from kirin.core.populate_pb import convert_to_gtfsrt, convert_to_gtfsrt_chunks, merge_differential_feeds
+from kirin.exceptions import MessageNotPublished
+from kirin.utils import str_to_date, record_call, set_rt_updates_status_ko
 from datetime import datetime
 from kombu.mixins import ConsumerProducerMixin
+import itertools
+import uuid
+
+# headers of the chunks of a full feed published in streaming mode (see RTReloader._stream_full_feed())
+CHUNK_FEED_ID_HEADER = "kirin_full_feed_id"
+CHUNK_INDEX_HEADER = "kirin_chunk_index"
+CHUNK_IS_LAST_HEADER = "kirin_chunk_is_last"
 
 
 class RTReloader(ConsumerProducerMixin):
@@ -52,11 +66,18 @@ class RTReloader(ConsumerProducerMixin):
     ConsumerProducerMixin: a RPC model
     """
 
-    def __init__(self, connection, rpc_queue, exchange, max_retries):
+    def __init__(self, connection, rpc_queue, exchange, max_retries, streaming=False, chunk_max_size=None):
+        """
+        :param streaming: if True, the full feed is read from db and published by chunks
+            (see _stream_full_feed()) instead of a single FeedMessage
+        :param chunk_max_size: max size (in bytes) of each chunk published in streaming mode
+        """
         self.connection = connection
         self.rpc_queue = rpc_queue
         self.exchange = exchange
         self.max_retries = max_retries
+        self.streaming = streaming
+        self.chunk_max_size = chunk_max_size
 
     def get_consumers(self, Consumer, channel):
         return [Consumer(queues=[self.rpc_queue], on_message=self.on_request, prefetch_count=1)]
@@ -96,6 +117,10 @@ class RTReloader(ConsumerProducerMixin):
             if hasattr(task.load_realtime, "end_date"):
                 if task.load_realtime.end_date:
                     end_date = str_to_date(task.load_realtime.end_date)
+            if self.streaming:
+                self._stream_full_feed(task, begin_date, end_date, start_datetime)
+                return
+
             feed = convert_to_gtfsrt(
                 TripUpdate.find_by_contributor_period(task.load_realtime.contributors, begin_date, end_date),
                 gtfs_realtime_pb2.FeedHeader.FULL_DATASET,
@@ -106,18 +131,7 @@ class RTReloader(ConsumerProducerMixin):
                 "Starting of full feed publication {}, {}".format(len(feed_str), task),
                 extra={"size": len(feed_str), "task": task},
             )
-            # http://docs.celeryproject.org/projects/kombu/en/latest/userguide/producers.html#bypassing-routing-by-using-the-anon-exchange
-            self.producer.publish(
-                feed_str,
-                routing_key=task.load_realtime.queue_name,
-                retry=True,
-                retry_policy={
-                    "interval_start": 0,  # First retry immediately,
-                    "interval_step": 2,  # then increase by 2s for every retry.
-                    "interval_max": 10,  # but don't exceed 10s between retries.
-                    "max_retries": self.max_retries,  # give up after 10 (by default) tries.
-                },
-            )
+            self._publish(feed_str, task)
             duration = (datetime.utcnow() - start_datetime).total_seconds()
             log.info("End of full feed publication", extra={"duration": duration, "task": task})
             record_call(
@@ -131,21 +145,166 @@ class RTReloader(ConsumerProducerMixin):
         finally:
             db.session.remove()
 
+    def _stream_full_feed(self, task, begin_date, end_date, start_datetime):
+        """
+        Publish the full feed as a sequence of FeedMessages (each one being at most chunk_max_size bytes),
+        without loading all TripUpdates in memory.
+        Each chunk is published with the headers:
+            * CHUNK_FEED_ID_HEADER: id shared by all the chunks of the full feed
+            * CHUNK_INDEX_HEADER: index of the chunk in the full feed (starting at 0)
+            * CHUNK_IS_LAST_HEADER: True for the last chunk of the full feed
+        so that the receiver is able to reassemble them.
+        """
+        log = logging.getLogger(__name__)
+        log.info("Starting of streamed full feed publication {}".format(task), extra={"task": task})
+        feed_id = six.text_type(uuid.uuid4())
+        trip_updates = TripUpdate.stream_by_contributor_period(
+            task.load_realtime.contributors, begin_date, end_date
+        )
+        chunks = convert_to_gtfsrt_chunks(
+            trip_updates, gtfs_realtime_pb2.FeedHeader.FULL_DATASET, max_size=self.chunk_max_size
+        )
+        size = 0
+        trip_update_count = 0
+        chunk_count = 0
+        # a chunk is published once the next one is available, to know which one is the last
+        previous_chunk = None
+        for chunk in itertools.chain(chunks, [None]):
+            if previous_chunk is not None:
+                chunk_str = previous_chunk.SerializeToString()
+                headers = {
+                    CHUNK_FEED_ID_HEADER: feed_id,
+                    CHUNK_INDEX_HEADER: chunk_count,
+                    CHUNK_IS_LAST_HEADER: chunk is None,
+                }
+                self._publish(chunk_str, task, headers=headers)
+                size += len(chunk_str)
+                trip_update_count += len(previous_chunk.entity)
+                chunk_count += 1
+            previous_chunk = chunk
+
+        duration = (datetime.utcnow() - start_datetime).total_seconds()
+        log.info("End of streamed full feed publication", extra={"duration": duration, "task": task})
+        record_call(
+            "Full feed publication",
+            size=size,
+            routing_key=task.load_realtime.queue_name,
+            duration=duration,
+            trip_update_count=trip_update_count,
+            chunk_count=chunk_count,
+            contributor=task.load_realtime.contributors,
+        )
+
+    def _publish(self, feed_str, task, headers=None):
+        # http://docs.celeryproject.org/projects/kombu/en/latest/userguide/producers.html#bypassing-routing-by-using-the-anon-exchange
+        self.producer.publish(
+            feed_str,
+            routing_key=task.load_realtime.queue_name,
+            headers=headers,
+            retry=True,
+            retry_policy={
+                "interval_start": 0,  # First retry immediately,
+                "interval_step": 2,  # then increase by 2s for every retry.
+                "interval_max": 10,  # but don't exceed 10s between retries.
+                "max_retries": self.max_retries,  # give up after 10 (by default) tries.
+            },
+        )
+
 
 class RabbitMQHandler(object):
-    def __init__(self, connection_string, exchange):
-        self._connection = BrokerConnection(connection_string)
+    def __init__(
+        self, connection_string, exchange, producer_pool_size=4, confirm_publish=False, async_config=None
+    ):
+        """
+        :param producer_pool_size: max number of idle producers (each one with its own channel) kept
+            to publish feeds
+        :param confirm_publish: if True, each publication waits for the broker's confirmation
+        :param async_config: if provided, submit() publishes asynchronously (see AsyncPublisher),
+            dict of AsyncPublisher's parameters
+        """
+        self._connection = BrokerConnection(
+            connection_string, transport_options={"confirm_publish": True} if confirm_publish else None
+        )
         self._connections = {self._connection}  # set of connection for the heartbeat
         self._exchange = Exchange(exchange, durable=True, delivery_mode=2, type="topic")
+        # producers (and their channels) are kept between publications, they are dropped on errors
+        self._producers = six.moves.queue.LifoQueue(maxsize=producer_pool_size)
+        self._is_exchange_declared = False
+        self._publish_stats = PublishStats()
+        self._async_publisher = None
+        if async_config is not None:
+            # a dedicated handler (and connection) using publisher confirms is used by the background sender
+            sync_handler = RabbitMQHandler(
+                connection_string, exchange, producer_pool_size=producer_pool_size, confirm_publish=True
+            )
+            self._async_publisher = AsyncPublisher(sync_handler, **async_config)
         monitor_heartbeats(self._connections)
 
+    def submit(self, item, contributor_id, rt_update_id=None):
+        """
+        Publish a DIFFERENTIAL feed: asynchronously if configured, synchronously otherwise
+        :param rt_update_id: id of the RealTimeUpdate the feed comes from, set KO if the asynchronous
+            publication fails
+        """
+        if self._async_publisher is not None:
+            self._async_publisher.submit(item, contributor_id, rt_update_id)
+        else:
+            self.publish(item, contributor_id)
+
     @retry(wait_fixed=200, stop_max_attempt_number=3)
     def publish(self, item, contributor_id):
-        with self._connection.channel() as channel:
-            with Producer(channel) as producer:
-                producer.publish(
-                    item, exchange=self._exchange, routing_key=contributor_id, declare=[self._exchange]
-                )
+        start = time.time()
+        producer = self._acquire_producer()
+        try:
+            # the exchange is declared on first publication (and after an error) only
+            declare = [] if self._is_exchange_declared else [self._exchange]
+            producer.publish(item, exchange=self._exchange, routing_key=contributor_id, declare=declare)
+            self._is_exchange_declared = True
+        except Exception as e:
+            self._publish_stats.add_error()
+            self._reset_producers(producer, e)
+            raise
+        self._release_producer(producer)
+        duration = time.time() - start
+        self._publish_stats.add(duration)
+        new_relic.record_custom_parameter("rabbitmq_publish_duration", duration)
+
+    def _acquire_producer(self):
+        try:
+            return self._producers.get_nowait()
+        except six.moves.queue.Empty:
+            return Producer(self._connection.channel())
+
+    def _release_producer(self, producer):
+        try:
+            self._producers.put_nowait(producer)
+        except six.moves.queue.Full:
+            _close_producer(producer)
+
+    def _reset_producers(self, failed_producer, error):
+        """
+        Drop the producer that failed to publish, and all idle ones if the connection is broken
+        (they will be rebuilt on a fresh connection for next publications)
+        """
+        logging.getLogger(__name__).warning("dropping rabbitmq producer after error: {}".format(error))
+        self._is_exchange_declared = False
+        _close_producer(failed_producer)
+        if isinstance(error, self._connection.connection_errors):
+            while True:
+                try:
+                    _close_producer(self._producers.get_nowait())
+                except six.moves.queue.Empty:
+                    break
+            try:
+                self._connection.close()  # next channel() reconnects
+            except Exception:
+                logging.getLogger(__name__).exception("error while closing broken rabbitmq connection")
+
+    def publish_stats(self):
+        stats = self._publish_stats.to_dict()
+        if self._async_publisher is not None:
+            stats["async"] = self._async_publisher.stats()
+        return stats
 
     def info(self):
         info = self._connection.info()
@@ -159,17 +318,206 @@ class RabbitMQHandler(object):
         for c in self._connections:
             c.release()
 
-    def listen_load_realtime(self, queue_name, max_retries=10):
+    def listen_load_realtime(self, queue_name, max_retries=10, streaming=False, chunk_max_size=None):
         log = logging.getLogger(__name__)
 
         route = "task.load_realtime.*"
         log.info("listening route {} on exchange {}...".format(route, self._exchange))
         rt_queue = Queue(queue_name, routing_key=route, exchange=self._exchange, durable=False)
         RTReloader(
-            connection=self._connection, rpc_queue=rt_queue, exchange=self._exchange, max_retries=max_retries
+            connection=self._connection,
+            rpc_queue=rt_queue,
+            exchange=self._exchange,
+            max_retries=max_retries,
+            streaming=streaming,
+            chunk_max_size=chunk_max_size,
         ).run()
 
 
+class AsyncPublisher(object):
+    """
+    Publish DIFFERENTIAL feeds from a background sender, to decouple feed processing from broker's latency.
+
+    Feeds are pushed in a bounded in-process queue. If it is still full after submit_timeout (seconds),
+    the feed is not published (MessageNotPublished is raised), so that feeds of a contributor are never
+    published out of order.
+    The sender waits for feeds during coalesce_window (seconds) after the first one received, then feeds of
+    the same contributor are merged in a single message (see merge_differential_feeds()), and published
+    in the order they were received.
+    If a publication fails, the RealTimeUpdates of its feeds are set KO.
+    """
+
+    def __init__(self, rmq_handler, queue_size=1000, coalesce_window=0.2, max_batch_size=100, submit_timeout=5):
+        """
+        :param rmq_handler: RabbitMQHandler used (synchronously) by the sender
+        """
+        self._rmq_handler = rmq_handler
+        self._queue_size = queue_size
+        self._coalesce_window = coalesce_window
+        self._max_batch_size = max_batch_size
+        self._submit_timeout = submit_timeout
+        self._lock = threading.Lock()
+        self._queue = None
+        self._sender = None
+        self._pid = None
+        self._submitted_count = 0
+        self._published_count = 0
+        self._queue_full_count = 0
+        self._error_count = 0
+
+    def submit(self, item, contributor_id, rt_update_id=None):
+        self._ensure_sender()
+        try:
+            self._queue.put((contributor_id, item, rt_update_id), timeout=self._submit_timeout)
+        except six.moves.queue.Full:
+            with self._lock:
+                self._queue_full_count += 1
+            logging.getLogger(__name__).error(
+                "async publication queue is full, feed not published", extra={"contributor": contributor_id}
+            )
+            raise MessageNotPublished()
+        with self._lock:
+            self._submitted_count += 1
+
+    def _ensure_sender(self):
+        # the sender is started lazily in each process (workers are forked after the app is loaded)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = six.moves.queue.Queue(maxsize=self._queue_size)
+                self._sender = threading.Thread(target=self._run, name="kirin_async_publisher")
+                self._sender.daemon = True
+                self._sender.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = self._get_batch()
+            try:
+                self._publish_batch(batch)
+            except Exception:
+                # the sender must never die
+                logging.getLogger(__name__).exception("error in async publication")
+
+    def _get_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.time() + self._coalesce_window
+        while len(batch) < self._max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except six.moves.queue.Empty:
+                break
+        return batch
+
+    def _publish_batch(self, batch):
+        items_by_contributor = OrderedDict()
+        rt_update_ids_by_contributor = {}
+        for contributor_id, item, rt_update_id in batch:
+            items_by_contributor.setdefault(contributor_id, []).append(item)
+            if rt_update_id is not None:
+                rt_update_ids_by_contributor.setdefault(contributor_id, []).append(rt_update_id)
+
+        for contributor_id, items in items_by_contributor.items():
+            if len(items) == 1:
+                item = items[0]
+            else:
+                feeds = []
+                for feed_str in items:
+                    feed = gtfs_realtime_pb2.FeedMessage()
+                    feed.ParseFromString(feed_str)
+                    feeds.append(feed)
+                item = merge_differential_feeds(feeds).SerializeToString()
+            try:
+                self._rmq_handler.publish(item, contributor_id)
+            except Exception as e:
+                with self._lock:
+                    self._error_count += len(items)
+                logging.getLogger(__name__).exception(
+                    "impossible to publish {} feed(s) in rabbitmq".format(len(items)),
+                    extra={"contributor": contributor_id},
+                )
+                record_call("failure", reason="impossible to publish in rabbitmq", contributor=contributor_id)
+                self._set_not_published(contributor_id, rt_update_ids_by_contributor.get(contributor_id, []), e)
+                continue
+            with self._lock:
+                self._published_count += len(items)
+
+    def _set_not_published(self, contributor_id, rt_update_ids, error):
+        """
+        Set KO the RealTimeUpdates whose feeds were not published (already stored OK by their processing)
+        """
+        if not rt_update_ids:
+            return
+        try:
+            with app.app_context():
+                set_rt_updates_status_ko(
+                    contributor_id,
+                    rt_update_ids,
+                    "impossible to publish in rabbitmq: {}".format(error),
+                    is_reprocess_same_data_allowed=True,
+                )
+        except Exception:
+            logging.getLogger(__name__).exception(
+                "impossible to set KO the RealTimeUpdates not published", extra={"contributor": contributor_id}
+            )
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_size": self._queue.qsize() if self._queue is not None else 0,
+                "submitted_count": self._submitted_count,
+                "published_count": self._published_count,
+                "queue_full_count": self._queue_full_count,
+                "error_count": self._error_count,
+            }
+
+
+def _close_producer(producer):
+    try:
+        producer.channel.close()
+    except Exception:
+        pass  # the channel is probably already broken
+
+
+class PublishStats(object):
+    """
+    Latency metrics of the publications of a RabbitMQHandler (in seconds)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.error_count = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.last_duration = None
+
+    def add(self, duration):
+        with self._lock:
+            self.count += 1
+            self.total_duration += duration
+            self.max_duration = max(self.max_duration, duration)
+            self.last_duration = duration
+
+    def add_error(self):
+        with self._lock:
+            self.error_count += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "count": self.count,
+                "error_count": self.error_count,
+                "mean_duration": self.total_duration / self.count if self.count else None,
+                "max_duration": self.max_duration,
+                "last_duration": self.last_duration,
+            }
+
+
 def monitor_heartbeats(connections, rate=2):
     """
     launch the heartbeat of amqp, it's mostly for preventing the f@#$ firewall from dropping the connection
@@ -86,8 +86,17 @@ def purge_trip_update(self, config):
         until = datetime.date.today() - datetime.timedelta(days=int(config["nb_days_to_keep"]))
         logger.info("purge trip update for {} until {}".format(contributor, until))
 
-        TripUpdate.remove_by_contributors_and_period(contributors=[contributor], start_date=None, end_date=until)
-        logger.info("%s for %s is finished", func_name, contributor)
+        reports = TripUpdate.remove_by_contributors_and_period(
+            contributors=[contributor], start_date=None, end_date=until
+        )
+        logger.info(
+            "%s for %s is finished: %s trip updates purged in %s batches (%.3fs)",
+            func_name,
+            contributor,
+            sum(r["rows_purged"][TripUpdate.__table__.name] for r in reports),
+            len(reports),
+            sum(r["duration"] for r in reports),
+        )
 
 
 @celery.task(bind=True)
@@ -30,7 +30,11 @@
 # www.navitia.io
 
 from __future__ import absolute_import, print_function, unicode_literals, division
+import hashlib
 import logging
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
 
 import six
 from aniso8601 import parse_date
@@ -89,7 +93,9 @@ def to_navitia_utc_str(naive_utc_dt):
 
 def make_rt_update(raw_data, connector_type, contributor_id, status="OK"):
     """
-    Create an RealTimeUpdate object for the query and persist it
+    Create an RealTimeUpdate object for the query and add it to the session.
+    It is committed right away only if raw data is stored first (see is_raw_data_stored_first()),
+    otherwise it is committed with the results of its processing.
     """
     rt_update = model.RealTimeUpdate(
         raw_data, connector_type=connector_type, contributor_id=contributor_id, status=status
@@ -97,10 +103,16 @@ def make_rt_update(raw_data, connector_type, contributor_id, status="OK"):
     new_relic.record_custom_parameter("real_time_update_id", rt_update.id)
 
     model.db.session.add(rt_update)
-    model.db.session.commit()
+    if is_raw_data_stored_first():
+        model.db.session.commit()
     return rt_update
 
 
+def is_raw_data_stored_first():
+    # type: () -> bool
+    return bool(current_app.config.get(str("RT_UPDATE_STORE_RAW_FIRST"), False))
+
+
 def record_input_retrieval(contributor, duration_ms, **kwargs):
     params = {"duration": duration_ms, "contributor": contributor}
     params.update(kwargs)
@@ -108,6 +120,12 @@ def record_input_retrieval(contributor, duration_ms, **kwargs):
     new_relic.record_custom_event("kirin_input_retrieval", params)
 
 
+def record_builder_reload(contributor, reload_count, **kwargs):
+    params = {"contributor": contributor, "reload_count": reload_count}
+    params.update(kwargs)
+    new_relic.record_custom_event("kirin_builder_reload", params)
+
+
 def record_internal_failure(log, **kwargs):
     params = {"log": log}
     params.update(kwargs)
@@ -145,11 +163,47 @@ def build_redis_etag_key(contributor):
     return "|".join([contributor, "polling_HEAD"])
 
 
+def build_redis_content_hash_key(contributor):
+    # type: (unicode) -> unicode
+    return "|".join([contributor, "content_hash"])
+
+
+def build_redis_entity_hashes_key(contributor):
+    # type: (unicode) -> unicode
+    return "|".join([contributor, "entity_hashes"])
+
+
 def allow_reprocess_same_data(contributor_id):
     # type: (unicode) -> None
     from kirin import redis_client
 
     redis_client.delete(build_redis_etag_key(contributor_id))  # wipe previous' ETag memory
+    redis_client.delete(build_redis_content_hash_key(contributor_id))  # wipe previous' content hash memory
+    redis_client.delete(build_redis_entity_hashes_key(contributor_id))  # wipe previous' entities memory
+
+
+def is_same_content_as_last(contributor_id, content):
+    """
+    Compare the hash of content with the one of the last input of the contributor (stored in redis),
+    and store the new one.
+    If the processing of content fails and reprocess is allowed, the hash is wiped
+    (see allow_reprocess_same_data())
+    :return: True if content is the same as the last input of the contributor
+    """
+    from kirin import redis_client
+
+    if isinstance(content, six.text_type):
+        content = content.encode("utf-8")
+    content_hash = hashlib.sha1(content).hexdigest()
+    hash_key = build_redis_content_hash_key(contributor_id)
+    try:
+        if redis_client.get(hash_key) == content_hash:
+            return True
+        redis_client.set(hash_key, content_hash)
+    except ConnectionError:
+        # deduplication is only an optimization: content is processed anyway
+        logging.getLogger(__name__).exception("Exception with redis while checking content hash")
+    return False
 
 
 def set_rtu_status_ko(rtu, error, is_reprocess_same_data_allowed):
@@ -169,6 +223,23 @@ def set_rtu_status_ko(rtu, error, is_reprocess_same_data_allowed):
     rtu.error = error
 
 
+def set_rt_updates_status_ko(contributor_id, rt_update_ids, error, is_reprocess_same_data_allowed):
+    """
+    Set KO RealTimeUpdates already stored, and commit
+    :param contributor_id: contributor of the RealTimeUpdates
+    :param rt_update_ids: ids of the RealTimeUpdates to amend
+    :param error: error message to associate to RTUs
+    :param is_reprocess_same_data_allowed: If the same input is provided next time, should we
+    reprocess it (hoping a happier ending)
+    """
+    if is_reprocess_same_data_allowed:
+        allow_reprocess_same_data(contributor_id)
+    RealTimeUpdate.query.filter(RealTimeUpdate.id.in_(rt_update_ids)).update(
+        {"status": "KO", "error": error}, synchronize_session=False
+    )
+    model.db.session.commit()
+
+
 def save_rt_data_with_error(data, connector_type, contributor_id, error, is_reprocess_same_data_allowed):
     """
     Create and save RTU using given data, connector, contributor with a status KO
@@ -210,7 +281,7 @@ def manage_db_error(data, connector_type, contributor_id, error, is_reprocess_sa
     reprocess it (hoping a happier ending)
     """
     last = model.RealTimeUpdate.get_last_rtu(connector_type, contributor_id)
-    if last and last.status == "KO" and last.error == error and last.raw_data == six.binary_type(data):
+    if last and last.status == "KO" and last.error == error and last.raw_data_bytes == six.binary_type(data):
         poke_updated_at(last)
         if is_reprocess_same_data_allowed:
             allow_reprocess_same_data(contributor_id)
@@ -283,3 +354,73 @@ def get_lock(logger, lock_name, lock_timeout):
         if locked:
             logger.debug("releasing lock %s", lock_name)
             lock.release()
+
+
+# long-lived pools of workers running the concurrent calls to external services of each contributor, bounding
+# their concurrency (shared by all feeds processed in this process): {(contributor_id, concurrency): pool}
+_contributor_pools = {}
+_contributor_pools_lock = threading.Lock()
+
+
+def get_navitia_concurrency(contributor_id):
+    # type: (unicode) -> int
+    """
+    :return: the max number of concurrent navitia calls for the contributor
+    """
+    from kirin import app
+
+    concurrency_by_contributor = app.config.get(str("NAVITIA_CONCURRENCY_BY_CONTRIBUTOR")) or {}
+    concurrency = concurrency_by_contributor.get(contributor_id, app.config.get(str("NAVITIA_CONCURRENCY"), 1))
+    return max(1, int(concurrency))
+
+
+def _get_contributor_pool(contributor_id, concurrency):
+    """
+    :return: the pool of workers of the contributor (greenlets if gevent is used, threads otherwise)
+    """
+    from kirin import app
+
+    with _contributor_pools_lock:
+        pool = _contributor_pools.get((contributor_id, concurrency))
+        if pool is None:
+            if app.config.get(str("USE_GEVENT")):
+                import gevent.pool
+
+                pool = gevent.pool.Pool(concurrency)
+            else:
+                pool = ThreadPool(concurrency)
+            _contributor_pools[(contributor_id, concurrency)] = pool
+        return pool
+
+
+def run_concurrently(calls, contributor_id):
+    """
+    Run independent calls (typically to navitia), overlapping them with the contributor's pool of workers
+    (greenlets if gevent is used, threads otherwise, kept for the next calls).
+    The number of calls running at the same time for a contributor is bounded by get_navitia_concurrency().
+
+    :param calls: list of callables without argument
+    :param contributor_id: contributor for whom calls are made
+    :return: list of the calls' results, in the same order as calls.
+        If calls raised, the exception of the first one (in calls' order) is raised once all calls are done.
+    """
+    from kirin import app
+
+    calls = list(calls)
+    concurrency = get_navitia_concurrency(contributor_id)
+    if concurrency <= 1 or len(calls) <= 1:
+        return [call() for call in calls]
+
+    def run(call):
+        with app.app_context():
+            try:
+                return True, call()
+            except Exception:
+                return False, sys.exc_info()
+
+    results = _get_contributor_pool(contributor_id, concurrency).map(run, calls)
+
+    for is_ok, result in results:
+        if not is_ok:
+            six.reraise(*result)
+    return [result for _, result in results]
@@ -37,6 +37,7 @@ from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 from kirin import manager
 import kirin.command.purge_rt
+import kirin.command.rtu_partitioning
 
 migrate = Migrate(app, db)
 manager.add_command("db", MigrateCommand)
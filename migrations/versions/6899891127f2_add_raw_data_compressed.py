@@ -0,0 +1,26 @@
+"""
+Add a raw_data_compressed (binary) column to real_time_update
+
+Revision ID: 6899891127f2
+Revises: 75b9437c7af4
+Create Date: 2020-10-14 11:03:27.512804
+
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+# revision identifiers, used by Alembic.
+revision = "6899891127f2"
+down_revision = "75b9437c7af4"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column("real_time_update", sa.Column("raw_data_compressed", sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    # raw data stored compressed is lost
+    op.drop_column("real_time_update", "raw_data_compressed")
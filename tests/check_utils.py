@@ -32,8 +32,15 @@ from __future__ import absolute_import, print_function, unicode_literals, divisi
 import os
 from kirin import app
 import json
+import pytest
 from dateutil.parser import parse
 
+# benchmarks are slow and check nothing: they are only run if KIRIN_BENCHMARK is set.
+# Their results are logged (use py.test --log-cli-level=INFO to display them)
+benchmark = pytest.mark.skipif(
+    not os.getenv(str("KIRIN_BENCHMARK")), reason="benchmark (only run if KIRIN_BENCHMARK is set)"
+)
+
 
 def api_get(url, check=True, *args, **kwargs):
     """
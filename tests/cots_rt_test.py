@@ -30,7 +30,18 @@
 # www.navitia.io
 
 from __future__ import absolute_import, print_function, unicode_literals, division
-from kirin.cots.model_maker import _retrieve_interesting_pdp
+import logging
+import timeit
+
+from kirin.cots.model_maker import (
+    _retrieve_interesting_pdp,
+    _parse_cots_utc_naive_dt,
+    _parse_utc_naive_dt,
+    as_utc_naive_dt,
+    make_navitia_stop_times_by_sncf_code,
+    get_navitia_stop_time_sncf,
+)
+from tests.check_utils import benchmark
 
 
 def test_retrieve_interesting_pdp():
@@ -92,3 +103,67 @@ def test_retrieve_interesting_pdp():
         },
     ]
     assert _retrieve_interesting_pdp(list_pdp) == [list_pdp[1], list_pdp[3], list_pdp[8], list_pdp[5]]
+
+
+def test_get_navitia_stop_time_sncf():
+    def make_nav_st(codes):
+        return {"stop_point": {"stop_area": {"codes": [{"type": t, "value": v} for t, v in codes]}}}
+
+    st_1 = make_nav_st([("CR-CI-CH", "0087-111111-BV"), ("UIC8", "87111111")])
+    st_2 = make_nav_st([("CR-CI-CH", "0087-222222-BV"), ("CR-CI-CH", "0087-222222-00")])
+    st_3 = make_nav_st([("UIC8", "87333333")])
+    st_4 = make_nav_st([("CR-CI-CH", "0087-111111-BV")])  # lollipop
+    nav_vj = {"stop_times": [st_1, st_2, st_3, {"stop_point": {}}, st_4]}
+
+    index = make_navitia_stop_times_by_sncf_code(nav_vj)
+
+    assert get_navitia_stop_time_sncf("0087", "222222", "00", index) == (st_2, None)
+    assert get_navitia_stop_time_sncf("0087", "222222", "BV", index) == (st_2, None)
+    assert get_navitia_stop_time_sncf("0087", "111111", "BV", index) == (
+        st_1,
+        {"log": "duplicate stops", "stop_point_code": "0087-111111-BV"},
+    )
+    assert get_navitia_stop_time_sncf("0087", "333333", "BV", index) == (
+        None,
+        {"log": "missing stop point", "stop_point_code": "0087-333333-BV"},
+    )
+
+
+def test_parse_cots_datetime():
+    """
+    fast parsing of COTS datetimes gives the same result as the generic dateutil parsing
+    """
+    str_times = [
+        "2018-09-01T12:02:00+0000",
+        "2018-09-01T12:02:00+0200",
+        "2018-12-31T23:30:00-0100",
+        "2018-03-25T01:59:59+01:00",
+    ]
+    for str_time in str_times:
+        assert _parse_cots_utc_naive_dt(str_time) == _parse_utc_naive_dt(str_time)
+
+
+@benchmark
+def test_parse_cots_datetime_benchmark():
+    """
+    compare the fast parsing of COTS datetimes (with and without cache) with the generic dateutil parsing,
+    on datetimes repeated like in a COTS feed
+    """
+    str_times = ["2018-09-01T{:02d}:{:02d}:00+0200".format(h, m) for h in range(6, 12) for m in range(0, 60, 5)]
+    str_times = str_times * 10
+    fast_duration = min(
+        timeit.repeat(lambda: [_parse_cots_utc_naive_dt(t) for t in str_times], number=1, repeat=3)
+    )
+    generic_duration = min(
+        timeit.repeat(lambda: [_parse_utc_naive_dt(t) for t in str_times], number=1, repeat=3)
+    )
+    cached_duration = min(timeit.repeat(lambda: [as_utc_naive_dt(t) for t in str_times], number=1, repeat=3))
+    logging.getLogger(__name__).info(
+        "parsing of %s COTS datetimes: fast %.4fs, generic %.4fs (x%.1f), fast with cache %.4fs (x%.1f)",
+        len(str_times),
+        fast_duration,
+        generic_duration,
+        generic_duration / fast_duration,
+        cached_duration,
+        generic_duration / cached_duration,
+    )
@@ -195,3 +195,47 @@ def test_get_action_on_trip_add(mock_navitia_fixture):
 
         action_on_trip = model_maker._get_action_on_trip(train_numbers, dict_version, pdps)
         assert action_on_trip == ActionOnTrip.FIRST_TIME_ADDED.name
+
+
+def test_cots_referential_cache(mock_navitia_fixture, monkeypatch):
+    """
+    with COTS_REFERENTIAL_CACHE, navitia's referential objects are requested once
+    until navitia's publication date changes
+    """
+    from tests import mock_navitia
+
+    monkeypatch.setitem(app.config, str("COTS_REFERENTIAL_CACHE"), True)
+    monkeypatch.setitem(app.config, str("COTS_REFERENTIAL_CACHE_PUBDATE_CHECK_INTERVAL"), 0)
+    monkeypatch.setattr(
+        "navitia_wrapper._NavitiaWrapper.get_publication_date", lambda self: "20121212T121212.121212"
+    )
+    queries = []
+
+    def counting_navitia_query(self, query, q=None):
+        queries.append(query)
+        return mock_navitia.mock_navitia_query(self, query, q)
+
+    monkeypatch.setattr("navitia_wrapper._NavitiaWrapper.query", counting_navitia_query)
+    model_maker.clear_navitia_referential_cache()
+    with app.app_context():
+        contributor = model.Contributor(
+            id=COTS_CONTRIBUTOR_ID, navitia_coverage=None, connector_type=ConnectorType.cots.value
+        )
+        builder = KirinModelBuilder(contributor)
+        company_id = builder._get_navitia_company(model_maker.DEFAULT_COMPANY_ID)
+        assert company_id
+        nb_queries = len(queries)
+        assert nb_queries > 0
+
+        # the company is now cached in the process, for every builder
+        assert builder._get_navitia_company(model_maker.DEFAULT_COMPANY_ID) == company_id
+        assert KirinModelBuilder(contributor)._get_navitia_company(model_maker.DEFAULT_COMPANY_ID) == company_id
+        assert len(queries) == nb_queries
+
+        # a new navitia's publication date invalidates the cache
+        monkeypatch.setattr(
+            "navitia_wrapper._NavitiaWrapper.get_publication_date", lambda self: "20201212T121212.121212"
+        )
+        assert builder._get_navitia_company(model_maker.DEFAULT_COMPANY_ID) == company_id
+        assert len(queries) == 2 * nb_queries
+    model_maker.clear_navitia_referential_cache()
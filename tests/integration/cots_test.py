@@ -29,6 +29,7 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 from __future__ import absolute_import, print_function, unicode_literals, division
+import re
 from datetime import datetime, timedelta
 
 import pytest
@@ -39,6 +40,7 @@ from kirin import app
 from tests import mock_navitia
 from tests.check_utils import get_fixture_data
 from kirin.core.model import RealTimeUpdate, TripUpdate, StopTimeUpdate
+from kirin.utils import allow_reprocess_same_data
 from tests.integration.utils_cots_test import requests_mock_cause_message
 from tests.integration.conftest import COTS_CONTRIBUTOR_ID
 from tests.integration.utils_sncf_test import (
@@ -134,6 +136,143 @@ def test_cots_simple_post(mock_rabbitmq):
     assert mock_rabbitmq.call_count == 1
 
 
+def test_cots_same_content_deduplication(mock_rabbitmq, monkeypatch):
+    """
+    with CONTENT_HASH_DEDUPLICATION, posting the same COTS twice processes it only once
+    """
+    monkeypatch.setitem(app.config, str("CONTENT_HASH_DEDUPLICATION"), True)
+    with app.app_context():
+        allow_reprocess_same_data(COTS_CONTRIBUTOR_ID)
+    cots_file = get_fixture_data("cots_train_96231_delayed.json")
+    assert api_post("/cots", data=cots_file) == "OK"
+    with app.app_context():
+        first_rtu = RealTimeUpdate.query.one()
+        first_updated_at = first_rtu.updated_at
+
+    assert api_post("/cots", data=cots_file) == "OK"
+    with app.app_context():
+        rtu = RealTimeUpdate.query.one()  # no new RealTimeUpdate
+        assert rtu.updated_at > first_updated_at  # but the last one is poked
+    assert mock_rabbitmq.call_count == 1
+
+    # a different content is processed
+    assert api_post("/cots", data=get_fixture_data("cots_train_96231_normal.json")) == "OK"
+    with app.app_context():
+        assert len(RealTimeUpdate.query.all()) == 2
+    assert mock_rabbitmq.call_count == 2
+    with app.app_context():
+        allow_reprocess_same_data(COTS_CONTRIBUTOR_ID)
+
+
+def test_cots_builder_reused(mock_rabbitmq, monkeypatch):
+    """
+    with BUILDER_CACHE, the COTS builder is built once for all the requests, until the contributor changes
+    """
+    from kirin.core.builder_cache import clear_builder_cache
+    from kirin.cots import KirinModelBuilder
+
+    built_builders = []
+
+    class SpyKirinModelBuilder(KirinModelBuilder):
+        def __init__(self, contributor):
+            super(SpyKirinModelBuilder, self).__init__(contributor)
+            built_builders.append(self)
+
+    monkeypatch.setattr("kirin.cots.cots.KirinModelBuilder", SpyKirinModelBuilder)
+    monkeypatch.setattr(
+        "navitia_wrapper._NavitiaWrapper.get_publication_date", lambda self: "20121212T121212.121212"
+    )
+    monkeypatch.setitem(app.config, str("BUILDER_CACHE"), True)
+    clear_builder_cache()
+
+    assert api_post("/cots", data=get_fixture_data("cots_train_96231_delayed.json")) == "OK"
+    assert api_post("/cots", data=get_fixture_data("cots_train_96231_normal.json")) == "OK"
+    assert len(built_builders) == 1
+
+    # the COTS contributor of the tests is configured in settings
+    monkeypatch.setitem(app.config, str("NAVITIA_TOKEN"), "new_token")
+    assert api_post("/cots", data=get_fixture_data("cots_train_96231_delayed.json")) == "OK"
+    assert len(built_builders) == 2
+    assert built_builders[-1].contributor.navitia_token == "new_token"
+    with app.app_context():
+        assert len(RealTimeUpdate.query.all()) == 3
+    clear_builder_cache()
+
+
+def test_cots_contributor_cache(monkeypatch):
+    """
+    the COTS contributor from db is requested once every COTS_CONTRIBUTOR_CACHE_TTL seconds
+    """
+    from kirin.core.model import Contributor
+    from kirin.cots import cots
+
+    monkeypatch.setitem(app.config, str("COTS_CONTRIBUTOR"), None)
+    searches = []
+    find_by_connector_type = Contributor.find_by_connector_type
+
+    def counting_find_by_connector_type(*args, **kwargs):
+        searches.append(args)
+        return find_by_connector_type(*args, **kwargs)
+
+    monkeypatch.setattr(Contributor, "find_by_connector_type", staticmethod(counting_find_by_connector_type))
+    cots.clear_cots_contributor_cache()
+    with app.app_context():
+        contributor = cots.get_cached_cots_contributor()
+        assert contributor.connector_type == ConnectorType.cots.value
+        assert cots.get_cached_cots_contributor() is contributor
+        assert len(searches) == 1
+
+        monkeypatch.setitem(app.config, str("COTS_CONTRIBUTOR_CACHE_TTL"), 0)
+        assert cots.get_cached_cots_contributor().id == contributor.id
+        assert len(searches) == 2
+    cots.clear_cots_contributor_cache()
+
+
+def test_cots_messages_stale_while_revalidate(monkeypatch, requests_mock):
+    """
+    with COTS_PAR_IV_CACHE_STALE_WHILE_REVALIDATE, the cached cause messages are served
+    while they are refreshed in background (a failed refresh is not attempted again right away)
+    """
+    from kirin.cots import message_handler
+
+    monkeypatch.setitem(app.config, str("COTS_PAR_IV_CACHE_STALE_WHILE_REVALIDATE"), True)
+    message_handler._refresh_attempts.clear()
+    with app.app_context():
+        app.cache.clear()
+        handler = message_handler.make_message_handler()
+        resource_url = "https://messages.service/resource"
+        assert re.match(r"^[\w.]+$", handler._messages_cache_key())  # valid for every cache backend
+
+        assert handler.warm_messages().get(1) == "Accident à un Passage à Niveau"
+        nb_calls = len([r for r in requests_mock.request_history if r.url == resource_url])
+        assert handler.get_message(index=1) == "Accident à un Passage à Niveau"
+        assert len([r for r in requests_mock.request_history if r.url == resource_url]) == nb_calls
+
+        # every cached referential is now due to be refreshed, but refreshes fail
+        monkeypatch.setitem(
+            app.config, str("COTS_PAR_IV_CACHE_REFRESH_AHEAD"), app.config[str("COTS_PAR_IV_CACHE_TIMEOUT")]
+        )
+        requests_mock.get(resource_url, status_code=500)
+        assert (
+            handler.get_message(index=1) == "Accident à un Passage à Niveau"
+        )  # the stale referential is served
+        for thread in list(message_handler._refresh_threads.values()):
+            thread.join()
+        assert len([r for r in requests_mock.request_history if r.url == resource_url]) == nb_calls + 1
+        assert handler.get_message(index=1) == "Accident à un Passage à Niveau"
+        for thread in list(message_handler._refresh_threads.values()):
+            thread.join()
+        assert len([r for r in requests_mock.request_history if r.url == resource_url]) == nb_calls + 1
+
+        monkeypatch.setitem(app.config, str("COTS_PAR_IV_CACHE_REFRESH_RETRY_INTERVAL"), 0)
+        assert handler.get_message(index=1) == "Accident à un Passage à Niveau"
+        for thread in list(message_handler._refresh_threads.values()):
+            thread.join()
+        assert len([r for r in requests_mock.request_history if r.url == resource_url]) == nb_calls + 2
+        app.cache.clear()
+    message_handler._refresh_attempts.clear()
+
+
 def test_save_bad_raw_cots():
     """
     send a bad formatted COTS, the bad raw COTS should be saved in db
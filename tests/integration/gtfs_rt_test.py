@@ -33,20 +33,29 @@ from __future__ import absolute_import, print_function, unicode_literals, divisi
 from copy import deepcopy
 from datetime import timedelta
 import datetime
+import json
 import pytest
 
 from kirin.core import model
 from kirin.core.abstract_builder import wrap_build
+from kirin.core.builder_cache import get_builder, clear_builder_cache
 from kirin.core.model import RealTimeUpdate, db, TripUpdate, StopTimeUpdate, VehicleJourney
 from kirin.core.populate_pb import to_posix_time, convert_to_gtfsrt
 from kirin import redis_client
 from kirin.core.types import TripEffect, ConnectorType
 from kirin.gtfs_rt import KirinModelBuilder
+from kirin.gtfs_rt.model_maker import _make_entity_key
 from kirin.tasks import purge_trip_update, purge_rt_update
 from tests import mock_navitia
 from tests.check_utils import api_post, api_get
 from kirin import gtfs_realtime_pb2, app
-from kirin.utils import save_rt_data_with_error, manage_db_error, build_redis_etag_key
+from kirin.utils import (
+    save_rt_data_with_error,
+    manage_db_error,
+    build_redis_etag_key,
+    allow_reprocess_same_data,
+    build_redis_entity_hashes_key,
+)
 from tests.integration.conftest import GTFS_CONTRIBUTOR_ID
 import time
 from sqlalchemy import desc
@@ -251,6 +260,42 @@ def test_gtfs_model_builder(basic_gtfs_rt_data, basic_gtfs_rt_data_without_delay
         assert trip_updates[0].effect == "UNKNOWN_EFFECT"
 
 
+def test_gtfs_model_builder_with_vj_batch_resolution(monkeypatch, basic_gtfs_rt_data):
+    """
+    with batch resolution, VJs of the feed are searched with a single request to navitia
+    and the result is dispatched to each trip (through _make_db_vj() cache)
+    """
+    monkeypatch.setitem(app.config, str("GTFS_RT_VJ_BATCH_RESOLUTION"), True)
+    nav_vj = json.loads(mock_navitia.vj_R_vj1.response.json_response)["vehicle_journeys"][0]
+    nav_vj["codes"] = [{"type": "source", "value": "Code-R-vj1"}]
+    navitia_queries = []
+
+    def mock_vehicle_journeys(q):
+        navitia_queries.append(q)
+        return [nav_vj]
+
+    with app.app_context():
+        app.cache.clear()
+        contributor = model.Contributor(
+            id=GTFS_CONTRIBUTOR_ID, navitia_coverage=None, connector_type=ConnectorType.gtfs_rt.value
+        )
+        builder = KirinModelBuilder(contributor)
+        monkeypatch.setattr(builder.navitia, "vehicle_journeys", mock_vehicle_journeys)
+        wrap_build(builder, basic_gtfs_rt_data)
+
+        assert len(navitia_queries) == 1
+        assert navitia_queries[0]["filter"] == "vehicle_journey.has_code(source, Code-R-vj1)"
+        trip_updates = TripUpdate.query.all()
+        assert len(trip_updates) == 1
+        assert trip_updates[0].vj.navitia_trip_id == nav_vj["trip"]["id"]
+        assert len(trip_updates[0].stop_time_updates) == 4
+
+        # VJ is now in cache: no more request
+        wrap_build(builder, basic_gtfs_rt_data)
+        assert len(navitia_queries) == 1
+        app.cache.clear()
+
+
 def test_gtfs_rt_simple_delay(basic_gtfs_rt_data, mock_rabbitmq):
     """
     test the gtfs-rt post with a simple gtfs-rt
@@ -325,6 +370,139 @@ def test_gtfs_rt_simple_delay(basic_gtfs_rt_data, mock_rabbitmq):
         assert fourth_stop.message is None
 
 
+def test_gtfs_rt_entity_diffing(
+    basic_gtfs_rt_data, basic_gtfs_rt_data_without_delays, mock_rabbitmq, monkeypatch
+):
+    """
+    with GTFS_RT_ENTITY_DIFFING, only the entities that changed since the previous feed are processed
+    """
+    monkeypatch.setitem(app.config, str("GTFS_RT_ENTITY_DIFFING"), True)
+    with app.app_context():
+        allow_reprocess_same_data(GTFS_CONTRIBUTOR_ID)
+    tester = app.test_client()
+    resp = tester.post("/gtfs_rt/{}".format(GTFS_CONTRIBUTOR_ID), data=basic_gtfs_rt_data)
+    assert resp.status_code == 200
+
+    # same entities in a newer feed
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(basic_gtfs_rt_data)
+    feed.header.timestamp += 60
+    feed.entity[0].trip_update.timestamp = feed.header.timestamp
+    resp = tester.post("/gtfs_rt/{}".format(GTFS_CONTRIBUTOR_ID), data=feed.SerializeToString())
+    assert resp.status_code == 200
+    with app.app_context():
+        rtu = RealTimeUpdate.query.order_by(desc(RealTimeUpdate.created_at)).first()
+        assert rtu.status == "KO"
+        assert rtu.error == "No new information destined to navitia for this gtfs-rt"
+        assert len(TripUpdate.query.all()) == 1
+        fourth_stop = TripUpdate.query.first().stop_time_updates[3]
+        assert fourth_stop.arrival_delay == timedelta(minutes=3)
+
+    # the entity changed
+    resp = tester.post("/gtfs_rt/{}".format(GTFS_CONTRIBUTOR_ID), data=basic_gtfs_rt_data_without_delays)
+    assert resp.status_code == 200
+    with app.app_context():
+        rtu = RealTimeUpdate.query.order_by(desc(RealTimeUpdate.created_at)).first()
+        assert rtu.status == "OK"
+        assert len(rtu.trip_updates) == 1
+        assert len(RealTimeUpdate.query.all()) == 3
+        allow_reprocess_same_data(GTFS_CONTRIBUTOR_ID)
+
+
+def test_gtfs_rt_entity_diffing_entity_without_trip_update(basic_gtfs_rt_data, mock_rabbitmq, monkeypatch):
+    """
+    with GTFS_RT_ENTITY_DIFFING, an entity that produced no TripUpdate (like when its VJ is not found in navitia)
+    is not considered as unchanged in the next feeds
+    """
+    monkeypatch.setitem(app.config, str("GTFS_RT_ENTITY_DIFFING"), True)
+    redis_client.delete(build_redis_entity_hashes_key(GTFS_CONTRIBUTOR_ID))
+    with app.app_context():
+        allow_reprocess_same_data(GTFS_CONTRIBUTOR_ID)
+
+    vj_searches = []
+    get_navitia_vjs = KirinModelBuilder._get_navitia_vjs
+
+    def get_navitia_vjs_unknown_trip(self, trip, *args, **kwargs):
+        vj_searches.append(trip.trip_id)
+        if trip.trip_id == "Code-unknown":
+            return []
+        return get_navitia_vjs(self, trip, *args, **kwargs)
+
+    monkeypatch.setattr(KirinModelBuilder, "_get_navitia_vjs", get_navitia_vjs_unknown_trip)
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(basic_gtfs_rt_data)
+    entity = feed.entity.add()
+    entity.id = "unknown"
+    entity.trip_update.trip.trip_id = "Code-unknown"
+    stu = entity.trip_update.stop_time_update.add()
+    stu.arrival.delay = 60
+    stu.stop_id = "Code-StopR2"
+    tester = app.test_client()
+    resp = tester.post("/gtfs_rt/{}".format(GTFS_CONTRIBUTOR_ID), data=feed.SerializeToString())
+    assert resp.status_code == 200
+    assert sorted(vj_searches) == ["Code-R-vj1", "Code-unknown"]
+    entity_hashes = redis_client.hgetall(build_redis_entity_hashes_key(GTFS_CONTRIBUTOR_ID))
+    assert set(entity_hashes) == {_make_entity_key(feed.entity[0].trip_update)}
+
+    # same entities in a newer feed: only the entity without TripUpdate is processed again
+    feed.header.timestamp += 60
+    del vj_searches[:]
+    resp = tester.post("/gtfs_rt/{}".format(GTFS_CONTRIBUTOR_ID), data=feed.SerializeToString())
+    assert resp.status_code == 200
+    assert vj_searches == ["Code-unknown"]
+    redis_client.delete(build_redis_entity_hashes_key(GTFS_CONTRIBUTOR_ID))
+    with app.app_context():
+        allow_reprocess_same_data(GTFS_CONTRIBUTOR_ID)
+
+
+def test_builder_cache(monkeypatch):
+    """
+    with BUILDER_CACHE, a builder is reused until its contributor or navitia's publication date changes
+    """
+    monkeypatch.setitem(app.config, str("BUILDER_CACHE"), True)
+    monkeypatch.setitem(app.config, str("BUILDER_CACHE_PUBDATE_CHECK_INTERVAL"), 0)
+    clear_builder_cache()
+    with app.app_context():
+        contributor = model.Contributor.query.get(GTFS_CONTRIBUTOR_ID)
+        builder = get_builder(KirinModelBuilder, contributor)
+        assert builder.contributor is not contributor  # builders get a copy of the contributor
+        assert builder.contributor.id == GTFS_CONTRIBUTOR_ID
+        assert get_builder(KirinModelBuilder, contributor) is builder
+
+        contributor.navitia_token = "new_token"
+        new_builder = get_builder(KirinModelBuilder, contributor)
+        assert new_builder is not builder
+        assert new_builder.contributor.navitia_token == "new_token"
+        db.session.rollback()
+
+        monkeypatch.setattr(
+            "navitia_wrapper._NavitiaWrapper.get_publication_date", lambda self: "20121212T121212.121212"
+        )
+        contributor = model.Contributor.query.get(GTFS_CONTRIBUTOR_ID)
+        builder = get_builder(KirinModelBuilder, contributor)
+        assert get_builder(KirinModelBuilder, contributor) is builder
+        monkeypatch.setattr(
+            "navitia_wrapper._NavitiaWrapper.get_publication_date", lambda self: "20201212T121212.121212"
+        )
+        assert get_builder(KirinModelBuilder, contributor) is not builder
+
+        # the publication date requested by a new builder is reused by the cache
+        publication_date_calls = []
+
+        def counting_get_publication_date(self):
+            publication_date_calls.append(self.url)
+            return "20201212T121212.121212"
+
+        monkeypatch.setattr(
+            "navitia_wrapper._NavitiaWrapper.get_publication_date", counting_get_publication_date
+        )
+        clear_builder_cache()
+        get_builder(KirinModelBuilder, contributor)
+        assert len(publication_date_calls) == 1
+    clear_builder_cache()
+
+
 def test_gtfs_rt_purge(basic_gtfs_rt_data, mock_rabbitmq):
     """
     POST a simple gtfs-rt, then test the purge
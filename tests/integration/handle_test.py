@@ -30,17 +30,20 @@
 # www.navitia.io
 from __future__ import absolute_import, print_function, unicode_literals, division
 from datetime import timedelta
+import logging
+import timeit
 
 import pytest
+import sqlalchemy
 
-from kirin.core.handler import handle
+from kirin.core.handler import handle, index_by_dated_vj
 from kirin.core.model import RealTimeUpdate, TripUpdate, VehicleJourney, StopTimeUpdate
 from kirin.core.types import ConnectorType
 from kirin.utils import make_rt_update
 from tests.integration.conftest import COTS_CONTRIBUTOR_ID
 import datetime
 from kirin import app, db
-from tests.check_utils import _dt
+from tests.check_utils import _dt, benchmark
 
 
 def create_trip_update(
@@ -169,6 +172,15 @@ def navitia_vj():
     }
 
 
+@pytest.fixture(params=[False, True], ids=["orm_persistence", "bulk_persistence"])
+def bulk_persistence(request, monkeypatch):
+    """
+    run the test with both persistence paths (see kirin.core.bulk_persist)
+    """
+    monkeypatch.setitem(app.config, str("BULK_PERSISTENCE"), request.param)
+    return request.param
+
+
 def _create_db_vj(navitia_vj):
     return VehicleJourney(
         navitia_vj, datetime.datetime(2015, 9, 8, 7, 10, 0), datetime.datetime(2015, 9, 8, 11, 5, 0)
@@ -614,7 +626,7 @@ def test_multiple_delays(setup_database, navitia_vj):
         assert len(StopTimeUpdate.query.all()) == 6  # 3 st * 2 vj in the db
 
 
-def test_multiple_delays_in_2_updates(navitia_vj):
+def test_multiple_delays_in_2_updates(navitia_vj, bulk_persistence):
     """
     same test as test_multiple_delays, but with nothing in the db and with 2 trip updates
     """
@@ -649,6 +661,81 @@ def test_multiple_delays_in_2_updates(navitia_vj):
         assert len(StopTimeUpdate.query.all()) == 3
 
 
+def test_unchanged_stop_time_updates_are_not_rewritten(navitia_vj, bulk_persistence):
+    """
+    when only one stop_time changes, the other StopTimeUpdates keep their row in db untouched,
+    and the modified one is updated in place
+    """
+    with app.app_context():
+        trip_update = TripUpdate(_create_db_vj(navitia_vj), status="update", contributor_id=COTS_CONTRIBUTOR_ID)
+        real_time_update = make_rt_update(
+            raw_data=None, connector_type=ConnectorType.cots.value, contributor_id=COTS_CONTRIBUTOR_ID
+        )
+        trip_update.stop_time_updates = [
+            StopTimeUpdate({"id": "sa:1"}, departure_delay=timedelta(minutes=5), dep_status="update")
+        ]
+        handle(real_time_update, [trip_update], contributor_id=COTS_CONTRIBUTOR_ID, is_new_complete=False)
+        rows_before = {
+            stu.stop_id: (stu.id, stu.created_at, stu.updated_at) for stu in StopTimeUpdate.query.all()
+        }
+        assert len(rows_before) == 3
+
+        trip_update = TripUpdate(_create_db_vj(navitia_vj), status="update", contributor_id=COTS_CONTRIBUTOR_ID)
+        real_time_update = make_rt_update(
+            raw_data=None, connector_type=ConnectorType.cots.value, contributor_id=COTS_CONTRIBUTOR_ID
+        )
+        trip_update.stop_time_updates = [
+            StopTimeUpdate({"id": "sa:2"}, arrival_delay=timedelta(minutes=2), arr_status="update")
+        ]
+        res, _ = handle(
+            real_time_update, [trip_update], contributor_id=COTS_CONTRIBUTOR_ID, is_new_complete=False
+        )
+
+        stus = res.trip_updates[0].stop_time_updates
+        assert [stu.stop_id for stu in stus] == ["sa:1", "sa:2", "sa:3"]
+        assert stus[0].departure == _dt("8:15")
+        assert stus[1].arrival == _dt("9:07")
+        assert stus[1].arrival_delay == timedelta(minutes=2)
+        rows_after = {
+            stu.stop_id: (stu.id, stu.created_at, stu.updated_at) for stu in StopTimeUpdate.query.all()
+        }
+        assert rows_after["sa:1"] == rows_before["sa:1"]
+        assert rows_after["sa:3"] == rows_before["sa:3"]
+        # the modified StopTimeUpdate kept its row
+        assert rows_after["sa:2"][:2] == rows_before["sa:2"][:2]
+        assert rows_after["sa:2"][2] > rows_before["sa:2"][2]
+
+
+@pytest.mark.parametrize("store_raw_first", [False, True], ids=["single_transaction", "store_raw_first"])
+def test_raw_data_stored_with_results(navitia_vj, bulk_persistence, store_raw_first, monkeypatch):
+    """
+    the raw RealTimeUpdate is committed before its processing only if RT_UPDATE_STORE_RAW_FIRST is activated,
+    otherwise it is committed along with the results of its processing
+    """
+    monkeypatch.setitem(app.config, str("RT_UPDATE_STORE_RAW_FIRST"), store_raw_first)
+    with app.app_context():
+        trip_update = TripUpdate(_create_db_vj(navitia_vj), status="update", contributor_id=COTS_CONTRIBUTOR_ID)
+        real_time_update = make_rt_update(
+            raw_data="raw", connector_type=ConnectorType.cots.value, contributor_id=COTS_CONTRIBUTOR_ID
+        )
+        db.session.rollback()  # only what was committed remains
+        assert (RealTimeUpdate.query.count() == 1) is store_raw_first
+
+        db.session.add(real_time_update)
+        trip_update.stop_time_updates = [
+            StopTimeUpdate({"id": "sa:1"}, departure_delay=timedelta(minutes=5), dep_status="update")
+        ]
+        handle(real_time_update, [trip_update], contributor_id=COTS_CONTRIBUTOR_ID, is_new_complete=False)
+        db.session.rollback()
+
+        db_real_time_updates = RealTimeUpdate.query.all()
+        assert len(db_real_time_updates) == 1
+        assert db_real_time_updates[0].raw_data == "raw"
+        assert db_real_time_updates[0].status == "OK"
+        assert len(db_real_time_updates[0].trip_updates) == 1
+        assert len(StopTimeUpdate.query.all()) == 3
+
+
 def test_delays_then_cancellation(setup_database, navitia_vj):
     """
     We have a delay on the first st of a vj in the db and we receive a cancellation on this vj,
@@ -675,7 +762,7 @@ def test_delays_then_cancellation(setup_database, navitia_vj):
         assert len(trip_update.real_time_updates) == 2
 
 
-def test_delays_then_cancellation_in_2_updates(navitia_vj):
+def test_delays_then_cancellation_in_2_updates(navitia_vj, bulk_persistence):
     """
     Same test as above, but with nothing in the db, and with 2 updates
     """
@@ -778,7 +865,7 @@ def test_cancellation_then_delay(navitia_vj):
         _check_cancellation_then_delay(res)
 
 
-def test_cancellation_then_delay_in_2_updates(navitia_vj):
+def test_cancellation_then_delay_in_2_updates(navitia_vj, bulk_persistence):
     """
     same as test_cancellation_then_delay, but with a clear db and in 2 updates
     """
@@ -800,3 +887,211 @@ def test_cancellation_then_delay_in_2_updates(navitia_vj):
         res, _ = handle(real_time_update, [trip_update], COTS_CONTRIBUTOR_ID, is_new_complete=False)
 
         _check_cancellation_then_delay(res)
+
+
+@pytest.fixture()
+def trip_updates_5k():
+    """
+    5000 TripUpdates on 2500 VJs circulating on 2 days: the size of a large GTFS-RT feed
+    """
+    trip_updates = []
+    for day in [8, 9]:
+        circulation_date = datetime.date(2015, 9, day)
+        for i in range(2500):
+            trip_updates.append(
+                TripUpdate(
+                    VehicleJourney(
+                        {
+                            "trip": {"id": "vehicle_journey:{}".format(i)},
+                            "stop_times": [{"utc_arrival_time": datetime.time(8, 10), "stop_point": {}}],
+                        },
+                        datetime.datetime.combine(circulation_date, datetime.time(7, 10)),
+                        datetime.datetime.combine(circulation_date, datetime.time(9, 10)),
+                    ),
+                    contributor_id=COTS_CONTRIBUTOR_ID,
+                )
+            )
+    return trip_updates
+
+
+def test_index_by_dated_vj(trip_updates_5k):
+    """
+    the index used by handle() to match incoming TripUpdates with the ones in db must give
+    the same result than a linear search, without being quadratic
+    """
+    index = index_by_dated_vj(trip_updates_5k)
+    for tu in trip_updates_5k:
+        assert index[(tu.vj.navitia_trip_id, tu.vj.start_timestamp)] is tu
+
+    for tu in trip_updates_5k[::50]:  # only a sample, a full linear search would be far too long
+        assert (
+            next(
+                t
+                for t in trip_updates_5k
+                if t.vj.navitia_trip_id == tu.vj.navitia_trip_id
+                and t.vj.start_timestamp == tu.vj.start_timestamp
+            )
+            is tu
+        )
+
+    assert len(index) == 5000
+
+
+@benchmark
+def test_index_by_dated_vj_benchmark(trip_updates_5k):
+    """
+    compare the search of TripUpdates by dated VJ through index_by_dated_vj() with a linear search
+    (like handle() did before), on a sample of 500 searches
+    """
+    searched_trip_updates = trip_updates_5k[::10]
+
+    def indexed_search():
+        index = index_by_dated_vj(trip_updates_5k)
+        return [index[(tu.vj.navitia_trip_id, tu.vj.start_timestamp)] for tu in searched_trip_updates]
+
+    def linear_search():
+        return [
+            next(
+                t
+                for t in trip_updates_5k
+                if t.vj.navitia_trip_id == tu.vj.navitia_trip_id
+                and t.vj.start_timestamp == tu.vj.start_timestamp
+            )
+            for tu in searched_trip_updates
+        ]
+
+    indexed_duration = min(timeit.repeat(indexed_search, number=1, repeat=3))
+    linear_duration = min(timeit.repeat(linear_search, number=1, repeat=3))
+    logging.getLogger(__name__).info(
+        "search of %s TripUpdates among %s: indexed %.4fs, linear %.4fs (x%.1f)",
+        len(searched_trip_updates),
+        len(trip_updates_5k),
+        indexed_duration,
+        linear_duration,
+        linear_duration / indexed_duration,
+    )
+
+
+def _make_navitia_vjs(nb_trips, nb_stops):
+    return [
+        {
+            "trip": {"id": "vehicle_journey:{}".format(i)},
+            "stop_times": [
+                {
+                    "utc_arrival_time": datetime.time(8, s),
+                    "utc_departure_time": datetime.time(8, s),
+                    "stop_point": {"id": "sa:{}".format(s), "stop_area": {"timezone": "UTC"}},
+                }
+                for s in range(nb_stops)
+            ],
+        }
+        for i in range(nb_trips)
+    ]
+
+
+def _make_feed(navitia_vjs, circulation_date, delay):
+    """
+    a feed delaying all the stops of the VJs (departures 1 more minute than arrivals)
+    """
+    real_time_update = make_rt_update(
+        raw_data=None, connector_type=ConnectorType.cots.value, contributor_id=COTS_CONTRIBUTOR_ID
+    )
+    trip_updates = []
+    for navitia_vj in navitia_vjs:
+        vj = VehicleJourney(
+            navitia_vj,
+            datetime.datetime.combine(circulation_date, datetime.time(7, 0)),
+            datetime.datetime.combine(circulation_date, datetime.time(9, 0)),
+        )
+        trip_update = TripUpdate(vj, status="update", contributor_id=COTS_CONTRIBUTOR_ID)
+        trip_update.stop_time_updates = [
+            StopTimeUpdate(
+                {"id": stop_time["stop_point"]["id"]},
+                departure_delay=timedelta(minutes=delay + 1),
+                arrival_delay=timedelta(minutes=delay),
+                dep_status="update",
+                arr_status="update",
+            )
+            for stop_time in navitia_vj["stop_times"]
+        ]
+        trip_updates.append(trip_update)
+    return real_time_update, trip_updates
+
+
+def _get_persisted_state(circulation_date):
+    """
+    every persisted column of the TripUpdates of the day, of their VJ and of their StopTimeUpdates
+    (except ids and timestamps), with their number of RealTimeUpdates
+    """
+
+    def get_columns(obj):
+        return tuple(
+            (attr.key, getattr(obj, attr.key))
+            for attr in sqlalchemy.inspect(obj).mapper.column_attrs
+            if attr.key not in ("id", "vj_id", "trip_update_id", "created_at", "updated_at")
+        )
+
+    db.session.expire_all()
+    return sorted(
+        (
+            get_columns(tu.vj),
+            get_columns(tu),
+            len(tu.real_time_updates),
+            sorted(get_columns(stu) for stu in tu.stop_time_updates),
+        )
+        for tu in TripUpdate.find_by_contributor_period(
+            [COTS_CONTRIBUTOR_ID], circulation_date, circulation_date
+        )
+    )
+
+
+def test_bulk_persistence_equivalence(monkeypatch):
+    """
+    the same feeds (new trips, then an update of all of them) persisted through the ORM and through
+    the bulk path give the same result in db
+    """
+    navitia_vjs = _make_navitia_vjs(nb_trips=3, nb_stops=4)
+    circulation_date = datetime.date(2015, 9, 8)
+    states = []
+    with app.app_context():
+        for is_bulk in [False, True]:
+            monkeypatch.setitem(app.config, str("BULK_PERSISTENCE"), is_bulk)
+            for delay in [5, 10]:
+                real_time_update, trip_updates = _make_feed(navitia_vjs, circulation_date, delay)
+                handle(real_time_update, trip_updates, COTS_CONTRIBUTOR_ID, is_new_complete=True)
+            states.append(_get_persisted_state(circulation_date))
+            TripUpdate.remove_by_contributors_and_period([COTS_CONTRIBUTOR_ID])
+
+        orm_state, bulk_state = states
+        assert len(orm_state) == 3
+        assert [len(stop_time_updates) for _, _, _, stop_time_updates in orm_state] == [4, 4, 4]
+        assert orm_state == bulk_state
+
+
+@benchmark
+def test_bulk_persistence_benchmark(monkeypatch):
+    """
+    compare the persistence of a large feed (new trips, then an update of all of them) through the ORM
+    and through the bulk path (on different days)
+    """
+    nb_trips, nb_stops = 300, 30
+    navitia_vjs = _make_navitia_vjs(nb_trips, nb_stops)
+    durations = {}
+    with app.app_context():
+        for is_bulk, circulation_date in [(False, datetime.date(2015, 9, 8)), (True, datetime.date(2015, 9, 9))]:
+            monkeypatch.setitem(app.config, str("BULK_PERSISTENCE"), is_bulk)
+            durations[is_bulk] = 0
+            for delay in [5, 10]:
+                real_time_update, trip_updates = _make_feed(navitia_vjs, circulation_date, delay)
+                start = timeit.default_timer()
+                handle(real_time_update, trip_updates, COTS_CONTRIBUTOR_ID, is_new_complete=True)
+                durations[is_bulk] += timeit.default_timer() - start
+
+    logging.getLogger(__name__).info(
+        "persistence of %s trips of %s stops (creation then update): ORM %.2fs, bulk %.2fs (x%.1f)",
+        nb_trips,
+        nb_stops,
+        durations[False],
+        durations[True],
+        durations[False] / durations[True],
+    )
@@ -33,7 +33,8 @@ from __future__ import absolute_import, print_function, unicode_literals, divisi
 
 from sqlalchemy.orm.exc import FlushError
 
-from kirin.core.model import VehicleJourney, TripUpdate, StopTimeUpdate, Contributor
+from kirin.core import rtu_partitions
+from kirin.core.model import VehicleJourney, TripUpdate, StopTimeUpdate, Contributor, RealTimeUpdate
 from kirin.core.types import ConnectorType
 from kirin.utils import make_rt_update
 from tests.integration.conftest import COTS_CONTRIBUTOR_ID, GTFS_CONTRIBUTOR_ID
@@ -96,6 +97,162 @@ def test_find_by_vj(setup_database):
         assert row.vj_id == "70866ce8-0638-4fa1-8556-1ddfa22d09d4"
 
 
+def test_stream_by_contributor_period(setup_database):
+    with app.app_context():
+        for start_date, end_date in [
+            (None, None),
+            (datetime.date(2015, 9, 9), None),
+            (None, datetime.date(2015, 9, 8)),
+        ]:
+            expected = TripUpdate.find_by_contributor_period([COTS_CONTRIBUTOR_ID], start_date, end_date)
+            streamed = TripUpdate.stream_by_contributor_period(
+                [COTS_CONTRIBUTOR_ID], start_date, end_date, batch_size=2
+            )
+            assert sorted(tu.vj_id for tu in streamed) == sorted(tu.vj_id for tu in expected)
+
+        assert list(TripUpdate.stream_by_contributor_period([GTFS_CONTRIBUTOR_ID], batch_size=2)) == []
+
+
+def test_remove_by_contributors_and_period(setup_database):
+    with app.app_context():
+        trip_update = TripUpdate.find_by_dated_vj("vehicle_journey:2", datetime.datetime(2015, 9, 8, 8, 0))
+        trip_update.stop_time_updates.append(StopTimeUpdate({"id": "sa:1"}, None, None, order=0))
+        rtu = make_rt_update("", ConnectorType.cots.value, contributor_id=COTS_CONTRIBUTOR_ID)
+        rtu.trip_updates.append(trip_update)
+        db.session.commit()
+
+        reports = TripUpdate.remove_by_contributors_and_period(
+            [COTS_CONTRIBUTOR_ID], end_date=datetime.date(2015, 9, 8), batch_size=1
+        )
+        assert len(reports) == 2
+        assert [r["rows_purged"]["trip_update"] for r in reports] == [1, 1]
+        assert [r["rows_purged"]["vehicle_journey"] for r in reports] == [1, 1]
+        assert sum(r["rows_purged"]["stop_time_update"] for r in reports) == 1
+        assert sum(r["rows_purged"]["associate_realtimeupdate_tripupdate"] for r in reports) == 1
+
+        assert [tu.vj_id for tu in TripUpdate.query.all()] == ["70866ce8-0638-4fa1-8556-1ddfa22d09d5"]
+        assert VehicleJourney.query.count() == 1
+        assert StopTimeUpdate.query.count() == 0
+        assert rtu.trip_updates == []
+
+        assert TripUpdate.remove_by_contributors_and_period([GTFS_CONTRIBUTOR_ID]) == []
+        assert TripUpdate.query.count() == 1
+
+
+def create_dated_real_time_updates(today):
+    """
+    Create a RealTimeUpdate linked to a TripUpdate and another one not linked, 5 days ago, and one today
+    :return: ids of the RealTimeUpdates created (linked, not linked, today)
+    """
+    rtus = []
+    for created_at, trip_update in [
+        (
+            today - datetime.timedelta(days=5),
+            create_trip_update("70866ce8-0638-4fa1-8556-1ddfa22d09d3", "vehicle_journey:1", today),
+        ),
+        (today - datetime.timedelta(days=5), None),
+        (today, None),
+    ]:
+        rtu = make_rt_update("", ConnectorType.cots.value, contributor_id=COTS_CONTRIBUTOR_ID)
+        rtu.created_at = datetime.datetime.combine(created_at, datetime.time(12, 0))
+        if trip_update:
+            rtu.trip_updates.append(trip_update)
+        rtus.append(rtu)
+    db.session.commit()
+    return [rtu.id for rtu in rtus]
+
+
+def test_remove_rtu_by_connectors_until():
+    with app.app_context():
+        today = datetime.datetime.utcnow().date()
+        linked_id, not_linked_id, today_id = create_dated_real_time_updates(today)
+
+        RealTimeUpdate.remove_by_connectors_until([ConnectorType.cots.value], today - datetime.timedelta(days=1))
+
+        assert not rtu_partitions.is_partitioned(db.session)
+        assert sorted(rtu.id for rtu in RealTimeUpdate.query.all()) == sorted([linked_id, today_id])
+        assert TripUpdate.query.count() == 1
+
+
+def test_remove_rtu_by_connectors_until_partitioned(monkeypatch):
+    monkeypatch.setitem(app.config, str("RT_UPDATE_PARTITIONS_AHEAD_DAYS"), 2)
+    with app.app_context():
+        if not rtu_partitions.is_partitioning_supported(db.session):
+            pytest.skip("partitioning of real_time_update requires PostgreSQL >= 11")
+        today = datetime.datetime.utcnow().date()
+        old_day = today - datetime.timedelta(days=5)
+        linked_id, not_linked_id, today_id = create_dated_real_time_updates(today)
+        connector_partition = rtu_partitions.connector_partition_name(ConnectorType.cots.value)
+
+        rtu_partitions.partition_real_time_update(db.session, ahead_days=1)
+        db.session.commit()
+        try:
+            assert rtu_partitions.is_partitioned(db.session)
+            assert rtu_partitions.get_partitions(db.session, connector_partition) == {
+                rtu_partitions.default_partition_name(ConnectorType.cots.value),
+                rtu_partitions.daily_partition_name(ConnectorType.cots.value, old_day),
+                rtu_partitions.daily_partition_name(ConnectorType.cots.value, today),
+            }
+            assert RealTimeUpdate.query.count() == 3
+
+            RealTimeUpdate.remove_by_connectors_until(
+                [ConnectorType.cots.value], today - datetime.timedelta(days=1)
+            )
+
+            # the partition of 5 days ago is dropped, the one of tomorrow is created
+            assert rtu_partitions.get_partitions(db.session, connector_partition) == {
+                rtu_partitions.default_partition_name(ConnectorType.cots.value),
+                rtu_partitions.daily_partition_name(ConnectorType.cots.value, today),
+                rtu_partitions.daily_partition_name(
+                    ConnectorType.cots.value, today + datetime.timedelta(days=1)
+                ),
+            }
+            # the linked RealTimeUpdate is kept (moved to the default partition), with its link
+            assert sorted(rtu.id for rtu in RealTimeUpdate.query.all()) == sorted([linked_id, today_id])
+            assert (
+                db.session.execute(
+                    "SELECT count(*) FROM {}".format(
+                        rtu_partitions.default_partition_name(ConnectorType.cots.value)
+                    )
+                ).scalar()
+                == 1
+            )
+            assert [rtu.id for rtu in TripUpdate.query.one().real_time_updates] == [linked_id]
+        finally:
+            db.session.rollback()
+            rtu_partitions.unpartition_real_time_update(db.session)
+            db.session.commit()
+
+        assert not rtu_partitions.is_partitioned(db.session)
+        assert sorted(rtu.id for rtu in RealTimeUpdate.query.all()) == sorted([linked_id, today_id])
+        assert [rtu.id for rtu in TripUpdate.query.one().real_time_updates] == [linked_id]
+
+
+@pytest.mark.parametrize("compression", [False, True])
+def test_rtu_raw_data_storage(compression, monkeypatch):
+    monkeypatch.setitem(app.config, str("RT_UPDATE_RAW_DATA_COMPRESSION"), compression)
+    with app.app_context():
+        text_rtu = make_rt_update("données", ConnectorType.cots.value, contributor_id=COTS_CONTRIBUTOR_ID)
+        empty_rtu = make_rt_update(None, ConnectorType.cots.value, contributor_id=COTS_CONTRIBUTOR_ID)
+        db.session.commit()
+        text_rtu_id, empty_rtu_id = text_rtu.id, empty_rtu.id
+        db.session.expunge_all()
+
+        text_rtu = RealTimeUpdate.query.get(text_rtu_id)
+        assert text_rtu.raw_data == "données"
+        assert text_rtu.raw_data_bytes == "données".encode("utf-8")
+        assert (text_rtu._raw_data_compressed is not None) is compression
+        assert RealTimeUpdate.query.get(empty_rtu_id).raw_data is None
+
+        if compression:
+            # binary raw data (like a GTFS-RT protobuf) can only be stored compressed
+            binary_rtu = make_rt_update(b"\x08\xff\x00", ConnectorType.gtfs_rt.value, GTFS_CONTRIBUTOR_ID)
+            db.session.commit()
+            binary_rtu_id = binary_rtu.id
+            db.session.expunge_all()
+            assert RealTimeUpdate.query.get(binary_rtu_id).raw_data_bytes == b"\x08\xff\x00"
+
+
 def test_find_stop():
     with app.app_context():
         vj = create_trip_update("70866ce8-0638-4fa1-8556-1ddfa22d09d3", "vj1", datetime.date(2015, 9, 8))
@@ -113,6 +270,32 @@ def test_find_stop():
         assert vj.find_stop("sa:4") is None
 
 
+def test_find_stop_lollipop_and_reassign():
+    with app.app_context():
+        vj = create_trip_update("70866ce8-0638-4fa1-8556-1ddfa22d09d3", "vj1", datetime.date(2015, 9, 8))
+        st1 = StopTimeUpdate({"id": "sa:1"}, None, None, order=0)
+        st2 = StopTimeUpdate({"id": "sa:2"}, None, None, order=1)
+        st3 = StopTimeUpdate({"id": "sa:1"}, None, None, order=2)
+        vj.stop_time_updates = [st1, st2, st3]
+
+        assert vj.find_stop("sa:1", 0) == st1
+        assert vj.find_stop("sa:1", 2) == st3
+        # fallback on stop_id only if order doesn't match
+        assert vj.find_stop("sa:1", 5) == st1
+        assert vj.find_stop("sa:1") == st1
+
+        # index must follow changes on stop_time_updates
+        st4 = StopTimeUpdate({"id": "sa:4"}, None, None, order=0)
+        vj.stop_time_updates = [st4, st2]
+        assert vj.find_stop("sa:1") is None
+        assert vj.find_stop("sa:4", 0) == st4
+        st5 = StopTimeUpdate({"id": "sa:5"}, None, None, order=2)
+        vj.stop_time_updates.append(st5)
+        assert vj.find_stop("sa:5", 2) == st5
+        vj.stop_time_updates.remove(st4)
+        assert vj.find_stop("sa:4") is None
+
+
 def test_find_activate():
     with app.app_context():
         create_real_time_update(
@@ -461,3 +644,22 @@ def test_contributor_creation():
             """
             db.session.add(contrib_with_same_id)
             db.session.commit()
+
+
+def test_find_navitia_stop_time():
+    vj = VehicleJourney(
+        {
+            "trip": {"id": "vj1"},
+            "stop_times": [
+                {"utc_arrival_time": datetime.time(8, 0), "stop_point": {"id": "sp:1"}},
+                {"utc_arrival_time": datetime.time(9, 0), "stop_point": {"id": "sp:2"}},
+                {"utc_arrival_time": datetime.time(10, 0), "stop_point": {"id": "sp:1"}},
+            ],
+        },
+        datetime.datetime(2015, 9, 8, 7, 0),
+        datetime.datetime(2015, 9, 8, 11, 0),
+    )
+    # first stop_time served at the stop_point is returned (lollipop)
+    assert vj.find_navitia_stop_time("sp:1")["utc_arrival_time"] == datetime.time(8, 0)
+    assert vj.find_navitia_stop_time("sp:2")["utc_arrival_time"] == datetime.time(9, 0)
+    assert vj.find_navitia_stop_time("sp:3") is None
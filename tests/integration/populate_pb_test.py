@@ -32,7 +32,13 @@ from __future__ import absolute_import, print_function, unicode_literals, divisi
 from datetime import timedelta
 
 from kirin.core.model import TripUpdate, VehicleJourney, StopTimeUpdate
-from kirin.core.populate_pb import convert_to_gtfsrt, to_posix_time, fill_stop_times
+from kirin.core.populate_pb import (
+    convert_to_gtfsrt,
+    convert_to_gtfsrt_chunks,
+    merge_differential_feeds,
+    to_posix_time,
+    fill_stop_times,
+)
 import datetime
 from kirin import app, db
 from kirin import gtfs_realtime_pb2, kirin_pb2
@@ -576,3 +582,74 @@ def test_populate_pb_for_added_trip():
         assert pb_stop_time.Extensions[kirin_pb2.stoptime_message] == "bob's on the track"
         assert pb_stop_time.arrival.Extensions[kirin_pb2.stop_time_event_status] == kirin_pb2.ADDED
         assert pb_stop_time.departure.Extensions[kirin_pb2.stop_time_event_status] == kirin_pb2.SCHEDULED
+
+
+def test_convert_to_gtfsrt_chunks():
+    """
+    trip_updates are split in several FeedMessages of bounded size, with the same header
+    """
+    with app.app_context():
+        real_time_update = make_rt_update(
+            raw_data=None, connector_type=ConnectorType.cots.value, contributor_id=COTS_CONTRIBUTOR_ID
+        )
+        for i in range(10):
+            navitia_vj = {
+                "trip": {"id": "vehicle_journey:{}".format(i)},
+                "stop_times": [
+                    {
+                        "utc_arrival_time": None,
+                        "utc_departure_time": datetime.time(8, 10),
+                        "stop_point": {"id": "sa:1", "stop_area": {"timezone": "UTC"}},
+                    }
+                ],
+            }
+            vj = VehicleJourney(
+                navitia_vj, datetime.datetime(2015, 9, 8, 7, 10, 0), datetime.datetime(2015, 9, 8, 9, 10, 0)
+            )
+            trip_update = TripUpdate(vj=vj, contributor_id=COTS_CONTRIBUTOR_ID)
+            trip_update.status = "delete"
+            real_time_update.trip_updates.append(trip_update)
+        db.session.add(real_time_update)
+        db.session.commit()
+
+        trip_updates = real_time_update.trip_updates
+        full_feed = convert_to_gtfsrt(trip_updates, gtfs_realtime_pb2.FeedHeader.FULL_DATASET)
+        max_size = full_feed.ByteSize() // 3
+
+        chunks = list(
+            convert_to_gtfsrt_chunks(trip_updates, gtfs_realtime_pb2.FeedHeader.FULL_DATASET, max_size=max_size)
+        )
+        assert len(chunks) > 2
+        for chunk in chunks:
+            assert chunk.ByteSize() <= max_size
+            assert chunk.header == chunks[0].header
+            assert chunk.header.incrementality == gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+        assert [e.id for c in chunks for e in c.entity] == [e.id for e in full_feed.entity]
+
+        # without max_size, or without trip_update, only one FeedMessage is generated
+        assert len(list(convert_to_gtfsrt_chunks(trip_updates))) == 1
+        chunks = list(convert_to_gtfsrt_chunks([], max_size=max_size))
+        assert len(chunks) == 1
+        assert len(chunks[0].entity) == 0
+
+
+def test_merge_differential_feeds():
+    """
+    only the newest version of each entity is kept, with the newest header
+    """
+    feeds = []
+    for timestamp, entity_ids in [(1, ["a", "b"]), (2, ["c"]), (3, ["a"])]:
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = "1"
+        feed.header.incrementality = gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+        feed.header.timestamp = timestamp
+        for entity_id in entity_ids:
+            entity = feed.entity.add()
+            entity.id = entity_id
+            entity.trip_update.trip.trip_id = "{}:{}".format(entity_id, timestamp)
+        feeds.append(feed)
+
+    merged = merge_differential_feeds(feeds)
+    assert merged.header.timestamp == 3
+    assert merged.header.incrementality == gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+    assert [e.trip_update.trip.trip_id for e in merged.entity] == ["b:1", "c:2", "a:3"]
@@ -85,6 +85,8 @@ def test_status(setup_database):
 
     assert "rabbitmq_info" in resp
     assert "password" not in resp["rabbitmq_info"]
+    assert "count" in resp["rabbitmq_publish_stats"]
+    assert "mean_duration" in resp["rabbitmq_publish_stats"]
 
 
 def test_status_from_db(setup_database):
@@ -30,7 +30,8 @@
 # www.navitia.io
 
 from __future__ import absolute_import, print_function, unicode_literals, division
-from kirin.utils import str_to_date
+from kirin.utils import str_to_date, run_concurrently
+from functools import partial
 import datetime
 
 
@@ -42,3 +43,51 @@ def test_valid_date():
 def test_invalid_date():
     res = str_to_date("aaaa")
     assert res == None
+
+
+def test_run_concurrently(monkeypatch):
+    from kirin import app, utils
+    import threading
+    import time
+    import pytest
+
+    monkeypatch.setitem(app.config, str("NAVITIA_CONCURRENCY"), 1)
+    monkeypatch.setitem(app.config, str("NAVITIA_CONCURRENCY_BY_CONTRIBUTOR"), {"realtime.concurrent": 3})
+
+    running = {"current": 0, "max": 0}
+    lock = threading.Lock()
+
+    def call(i):
+        with lock:
+            running["current"] += 1
+            running["max"] = max(running["max"], running["current"])
+        time.sleep(0.01 * (10 - i))  # first calls finish last
+        with lock:
+            running["current"] -= 1
+        return i
+
+    calls = [partial(call, i) for i in range(10)]
+
+    # results are in calls' order, concurrency is bounded by the contributor's limit
+    assert run_concurrently(calls, contributor_id="realtime.concurrent") == list(range(10))
+    assert running["max"] == 3
+
+    # the contributor's pool of workers is kept for the next calls
+    pool = utils._contributor_pools[("realtime.concurrent", 3)]
+    running["max"] = 0
+    assert run_concurrently(calls, contributor_id="realtime.concurrent") == list(range(10))
+    assert running["max"] == 3
+    assert utils._contributor_pools[("realtime.concurrent", 3)] is pool
+
+    # other contributors use the default limit: calls are done one after another
+    running["max"] = 0
+    assert run_concurrently(calls, contributor_id="realtime.other") == list(range(10))
+    assert running["max"] == 1
+
+    def failing_call(i):
+        raise ValueError("call {} failed".format(i))
+
+    calls = [partial(call, 0), partial(failing_call, 1), partial(failing_call, 2)]
+    with pytest.raises(ValueError) as e:
+        run_concurrently(calls, contributor_id="realtime.concurrent")
+    assert "call 1 failed" in str(e.value)